@@ -0,0 +1,313 @@
+import asyncio
+import atexit
+import threading
+import time
+from queue import Empty
+from urllib.parse import urlparse
+import aiohttp
+from settings import store as settings
+from downloader import HTTPStatusError
+from byterange import range_header
+from retry import get_breaker
+from segment_cache import segment_validators
+
+
+# All active downloads share one event loop running on a single daemon thread
+_loop = None
+_loop_lock = threading.Lock()
+_session = None
+_inflight = None
+
+
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="async-engine", daemon=True).start()
+        return _loop
+
+
+class InflightLimit:
+    """ An asyncio.Semaphore that can be resized while requests hold it """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._used = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._used < self.limit)
+            self._used += 1
+
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self._used -= 1
+            self._cond.notify()
+
+    async def resize(self, limit):
+        async with self._cond:
+            self.limit = limit
+            self._cond.notify_all()
+
+
+def _get_session():
+    # Only ever called from the loop thread, so no locking is needed
+    global _session, _inflight
+    if _session is None:
+        _inflight = InflightLimit(settings.get("async_max_inflight", 256))
+        # No pool limit of its own: _inflight bounds the requests, and unlike the connector it can be resized
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        settings.subscribe(_apply_settings)
+    return _session
+
+
+def _apply_settings(new_settings):
+    asyncio.run_coroutine_threadsafe(_inflight.resize(new_settings["async_max_inflight"]), _loop)
+
+
+async def _wait_resumed(worker):
+    # threading.Event can't be awaited, so poll it without blocking the loop
+    while not worker._pause.is_set():
+        await asyncio.sleep(0.2)
+
+
+async def _backoff(worker, delay, interrupted=None):
+    deadline = time.monotonic() + delay
+    while not worker.stopped and time.monotonic() < deadline and not (interrupted and interrupted()):
+        await asyncio.sleep(min(0.2, max(0.0, deadline - time.monotonic())))
+
+
+async def _throttle(worker, nbytes):
+    delay, changed = worker._bandwidth_delay(nbytes)
+    if delay:
+        await _backoff(worker, delay, changed)
+
+
+async def _save(worker, needs_slot, fn, *args):
+    """
+    Run a save step (_finish_stream, _save_fetched) right on the loop thread.
+    The CPU pool slot it hands its work over with is awaited here first, so
+    the step never blocks the loop; one it didn't use is given back. Returns
+    what fn does, or None without running it if the job stopped meanwhile.
+    """
+    if needs_slot:
+        if not await worker.cpu_pool.acquire_async(lambda: worker.stopped):
+            return None
+        worker._slot_taken.held = True
+    try:
+        return fn(*args)
+    finally:
+        if getattr(worker._slot_taken, "held", False):
+            worker._slot_taken.held = False
+            worker.cpu_pool.release()
+
+
+async def _fetch_buffered(session, worker, segment_url, ranges, timeout):
+    headers = range_header(ranges) if ranges else None
+    start = time.perf_counter()
+    async with session.get(segment_url, timeout=timeout, headers=headers) as r:
+        # The response object exists once the headers are in: connect + TTFB
+        ttfb = time.perf_counter() - start
+        worker.metrics.observe("ttfb", ttfb)
+        if r.status not in ((200, 206) if ranges else (200,)):
+            raise HTTPStatusError(r.status, r.headers.get("Retry-After"))
+        chunks = []
+        async for chunk in r.content.iter_any():
+            chunks.append(chunk)
+            await _throttle(worker, len(chunk))
+        data = b"".join(chunks)
+        worker.metrics.observe("transfer", time.perf_counter() - start - ttfb)
+        return r.status, data, segment_validators(segment_url, r.headers)
+
+
+async def _fetch_streaming(session, worker, segment_url, stream, timeout, i=None):
+    start = time.perf_counter()
+    async with session.get(segment_url, timeout=timeout, headers=stream.resume_headers()) as r:
+        ttfb = time.perf_counter() - start
+        worker.metrics.observe("ttfb", ttfb)
+        if r.status not in (200, 206):
+            raise HTTPStatusError(r.status, r.headers.get("Retry-After"))
+        stream.begin(r.status, r.content_length)
+        stream.validators = segment_validators(segment_url, r.headers)
+        local = stream.decrypt_seconds + stream.write_seconds
+        # iter_any hands over whatever has arrived; aiohttp drops still-buffered bytes
+        # once the connection breaks, so reading eagerly keeps more of a partial body
+        async for chunk in r.content.iter_any():
+            # A hedge that already saved this segment cancels the rest of the read
+            if worker.stopped or i in worker._claimed:
+                break
+            # One positional write into the preallocated file: cheap enough to make inline
+            stream.write(chunk)
+            await _throttle(worker, len(chunk))
+        local = stream.decrypt_seconds + stream.write_seconds - local
+        worker.metrics.observe("transfer", max(0.0, time.perf_counter() - start - ttfb - local))
+    return stream.received
+
+
+async def _hedge(session, worker, i, segment_url, ranges):
+    """ One duplicate attempt for a straggling job; a failure just leaves the original to finish """
+    source, url = worker._hedge_route(i, segment_url)
+    host = urlparse(url).netloc
+    if not worker.controller.try_acquire():
+        return
+    if not await worker.scheduler.acquire_async(worker, host, lambda: worker.stopped):
+        worker.controller.release()
+        return
+    worker.metrics.hedged()
+    timeout = aiohttp.ClientTimeout(sock_connect=worker.timeout, sock_read=worker.timeout)
+    started = worker._source_begin(source)
+    try:
+        try:
+            async with _inflight:
+                status, data, validators = await _fetch_buffered(session, worker, url, ranges, timeout)
+        finally:
+            worker.scheduler.release(worker, host)
+            worker.controller.release()
+            worker._source_end(source)
+        worker._source_succeeded(source, host, len(data), started)
+        if not worker.stopped and await _save(worker, True, worker._save_fetched, i, data, ranges, status, validators):
+            worker.metrics.hedge_won()
+    except Exception as e:
+        worker.metrics.attempt_failed(e)
+        if source:
+            worker.sources.record_failure(source)
+
+
+async def _fetch_all(worker):
+    session = _get_session()
+    loop = asyncio.get_running_loop()
+    # worker.jobs is a thread-safe queue.Queue; a live refresher may still be adding to it
+    queue = worker.jobs
+    controller = worker.controller
+
+    async def fetch_loop():
+        while not worker.stopped:
+            await _wait_resumed(worker)
+            if worker.stopped:
+                break
+            try:
+                i, segment_url, ranges = queue.get_nowait()
+            except Empty:
+                if worker._jobs_closed.is_set():
+                    # Tail of the job: rather than exit, race a duplicate request against a straggler
+                    straggler = worker._pick_straggler()
+                    if straggler:
+                        await _hedge(session, worker, *straggler)
+                        continue
+                    if not worker._inflight:
+                        return
+                await asyncio.sleep(0.2)
+                continue
+
+            while worker.muxer and not worker.muxer.has_room(i) and not worker.stopped:
+                await asyncio.sleep(0.05)
+            # Reads the cache file, so it is the one step off the loop thread; skipped when the cache is off
+            if worker.cache and await loop.run_in_executor(None, worker._from_cache, i, ranges):
+                continue
+
+            streaming = not ranges and not worker.muxer
+            stream = None
+            source = None
+            retry = 0
+            # Also stop once a hedged duplicate has saved this job
+            while not worker.stopped and i not in worker._claimed:
+                await _wait_resumed(worker)
+                source, url = worker._route(i, segment_url, source, stream)
+                host = urlparse(url).netloc
+                breaker = get_breaker(host)
+                if not await breaker.wait_async(lambda: worker.stopped):
+                    break
+                while not controller.try_acquire() and not worker.stopped:
+                    await asyncio.sleep(0.05)
+                if worker.stopped:
+                    breaker.release()
+                    break
+                if not await worker.scheduler.acquire_async(worker, host, lambda: worker.stopped):
+                    controller.release()
+                    breaker.release()
+                    break
+                # Per-read timeouts like requests, so a long streamed segment isn't cut off.
+                # Built per attempt so a timeout changed in the settings applies straight away.
+                timeout = aiohttp.ClientTimeout(sock_connect=worker.timeout, sock_read=worker.timeout)
+                worker._attempt_started(i, url, ranges)
+                started = worker._source_begin(source)
+                try:
+                    try:
+                        async with _inflight:
+                            if streaming:
+                                if not stream:
+                                    # Only a key not fetched yet makes opening a stream block
+                                    stream = (worker._open_stream(i) if worker._key_ready(i)
+                                              else await loop.run_in_executor(None, worker._open_stream, i))
+                                nbytes = await _fetch_streaming(session, worker, url, stream, timeout, i)
+                            else:
+                                status, data, validators = await _fetch_buffered(session, worker, url, ranges, timeout)
+                                nbytes = len(data)
+                    finally:
+                        worker.scheduler.release(worker, host)
+                        controller.release()
+                        worker._source_end(source)
+                    if worker.stopped:
+                        breaker.release()
+                        break
+                    controller.on_success(nbytes)
+                    breaker.record_success()
+                    worker._source_succeeded(source, host, nbytes, started)
+                    if streaming:
+                        # Takes the stream over (unless it raises for a short body)
+                        won = await _save(worker, stream.key or worker.cache, worker._finish_stream, i, stream)
+                        stream = None
+                    else:
+                        won = await _save(worker, True, worker._save_fetched, i, data, ranges, status, validators)
+                    if won:
+                        worker._fetch_succeeded(i)
+                    break
+                except Exception as e:
+                    retry += 1
+                    delay = worker._attempt_failed(e, retry, breaker, source)
+                    if delay is None:
+                        worker._segment_gave_up(i, e, retry)
+                        break
+                    await _backoff(worker, delay)
+            worker._job_finished(i)
+            if stream:
+                stream.discard()
+
+    # Like the threaded engine, add fetch tasks as the controller's limit grows
+    tasks = set()
+    while True:
+        if worker.jobs_drained or worker.stopped:
+            if not tasks:
+                break
+            if worker._all_saved():
+                # Only requests that lost to their hedge are left
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                break
+        else:
+            while len(tasks) < controller.limit:
+                tasks.add(asyncio.ensure_future(fetch_loop()))
+        done, tasks = await asyncio.wait(tasks, timeout=0.2, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+
+
+@atexit.register
+def _shutdown():
+    if _loop is not None and _session is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(_session.close(), _loop).result(timeout=2)
+        except Exception:
+            pass
+
+
+def download_segments(worker):
+    """
+    Fetch every (index, url) job of a DownloadWorker's job queue on the shared loop.
+    Blocks the calling worker thread until all segments are done or it stops.
+    """
+    future = asyncio.run_coroutine_threadsafe(_fetch_all(worker), get_loop())
+    future.result()
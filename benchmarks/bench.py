@@ -0,0 +1,207 @@
+"""
+End-to-end throughput benchmark for DownloadWorker against a local HLS stand-in.
+
+    python benchmarks/bench.py --segments 200 --size 262144 --connections 4 8 16 --parallel 1 2
+    python benchmarks/bench.py --encrypted --latency 0.02 --error-rate 0.01 --bandwidth 20000000 --engine threads asyncio
+
+Every combination of --connections, --parallel and --engine runs in its own
+child process (so peak RSS belongs to that run alone) against the same
+server, which lives in this process. Reports segments/s, MB/s, p50/p99
+segment latency as seen by the server, peak RSS and mux time. With a real
+ffmpeg (--ffmpeg) the segments are real MPEG-2 video and the ffmpeg mux is
+timed; otherwise they are synthetic TS packets, joined natively (no ffmpeg).
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from hls_server import HLSServer
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def run_child(config):
+    """ Run config["parallel"] downloads of config["url"] at once and print one JSON result """
+    work_dir = tempfile.mkdtemp(prefix="m3u8-bench-")
+    # The settings file is relative to the working directory, so this keeps the user's untouched
+    os.chdir(work_dir)
+    from settings import save_settings, load_settings
+    settings = load_settings()
+    settings.update({
+        "output_dir": work_dir,
+        "num_connections": config["connections"],
+        "max_parallel": config["parallel"],
+        "engine": config["engine"],
+        "ffmpeg_path": config["ffmpeg"] or "ffmpeg",
+        # ffmpeg can't remux synthetic segments, but they join natively as TS
+        "output_format": "native" if config["synthetic"] else "mp4",
+        "enable_notifications": False
+    })
+    save_settings(settings)
+
+    from downloader import DownloadWorker
+
+    lock = threading.Lock()
+    jobs = {}
+    finished = threading.Event()
+
+    def progress(name, percent, downloaded_mb, estimated_mb, speed, connections=None, eta=None):
+        with lock:
+            job = jobs[name]
+            job["downloaded_mb"] = downloaded_mb
+            if percent >= 100:
+                job["segments_done_at"] = time.monotonic()
+
+    def done(name, success, msg):
+        with lock:
+            jobs[name].update(ok=success, message=msg, done_at=time.monotonic())
+            if all("done_at" in j for j in jobs.values()):
+                finished.set()
+
+    workers = []
+    for n in range(config["parallel"]):
+        name = f"bench{n}"
+        jobs[name] = {"downloaded_mb": 0.0}
+        workers.append(DownloadWorker(name, config["url"], work_dir, progress, done, config["connections"]))
+
+    start = time.monotonic()
+    for w in workers:
+        w.start()
+    finished.wait(config["timeout"])
+    end = time.monotonic()
+
+    with lock:
+        results = list(jobs.values())
+    segments_done = max((j.get("segments_done_at", end) for j in results), default=end)
+    mux_times = [j["done_at"] - j["segments_done_at"] for j in results if "done_at" in j and "segments_done_at" in j]
+    failures = [j.get("message", "timed out") for j in results if not j.get("ok")]
+    downloaded_mb = sum(j["downloaded_mb"] for j in results)
+    download_seconds = max(segments_done - start, 1e-6)
+
+    print(json.dumps({
+        "wall_seconds": end - start,
+        "download_seconds": download_seconds,
+        "downloaded_mb": downloaded_mb,
+        "mb_per_s": downloaded_mb / download_seconds,
+        "segments_per_s": config["segments"] * config["parallel"] / download_seconds,
+        "mux_seconds": max(mux_times) if mux_times else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "ok": not failures,
+        "failures": failures[:3]
+    }))
+    sys.stdout.flush()
+    # Segment folders and outputs are throwaway
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os._exit(0)
+
+
+def fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+def fmt_ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DownloadWorker against a local HLS server.")
+    parser.add_argument("--segments", type=int, default=200)
+    parser.add_argument("--size", type=int, default=256 * 1024, help="Segment size in bytes")
+    parser.add_argument("--duration", type=float, default=2.0, help="EXTINF seconds per segment")
+    parser.add_argument("--encrypted", action="store_true", help="AES-128 encrypt every segment")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added before each segment response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of segment requests answered with 503")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Server-wide cap in bytes/s (0 = none)")
+    parser.add_argument("--connections", type=int, nargs="+", default=[8])
+    parser.add_argument("--parallel", type=int, nargs="+", default=[1])
+    parser.add_argument("--engine", nargs="+", default=["threads"], choices=["threads", "asyncio"])
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per combination")
+    parser.add_argument("--ffmpeg", help="FFmpeg used for real segments and the mux (default: synthetic data)")
+    parser.add_argument("--timeout", type=float, default=600, help="Give up on a run after this many seconds")
+    parser.add_argument("--json", help="Also write every result to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(json.loads(args.child))
+        return
+
+    server = HLSServer(args.segments, args.size, args.duration, args.encrypted, args.latency,
+                       args.error_rate, args.bandwidth, args.ffmpeg).start()
+    if not server.real_media:
+        print("Synthetic segments: output is joined natively, so the mux column is the native join.", file=sys.stderr)
+
+    header = f"{'engine':>8} {'conn':>5} {'par':>4} {'seg/s':>9} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'RSS MB':>8} {'mux s':>7}  ok"
+    print(header)
+    results = []
+    for engine, connections, parallel, _ in itertools.product(args.engine, args.connections, args.parallel, range(args.repeat)):
+        server.reset_stats()
+        config = {
+            "url": server.url,
+            "engine": engine,
+            "connections": connections,
+            "parallel": parallel,
+            "segments": args.segments,
+            "ffmpeg": args.ffmpeg,
+            "synthetic": not server.real_media,
+            "timeout": args.timeout
+        }
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", json.dumps(config)],
+                              capture_output=True, text=True)
+        try:
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            print(f"Run failed ({engine}, {connections} conn, {parallel} par):\n{proc.stderr.strip()}", file=sys.stderr)
+            continue
+
+        timings = list(server.timings)
+        result.update({
+            "engine": engine,
+            "connections": connections,
+            "parallel": parallel,
+            "p50_ms": fmt_ms(percentile(timings, 50)),
+            "p99_ms": fmt_ms(percentile(timings, 99)),
+            "injected_errors": server.errors
+        })
+        results.append(result)
+        print(f"{engine:>8} {connections:>5} {parallel:>4} {result['segments_per_s']:>9.1f} {result['mb_per_s']:>8.2f} "
+              f"{fmt(result['p50_ms'], '8.1f')} {fmt(result['p99_ms'], '8.1f')} {fmt(result['peak_rss_mb'], '8.1f')} "
+              f"{fmt(result['mux_seconds'], '7.2f')}  {'yes' if result['ok'] else 'NO'}")
+
+    server.stop()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k != "child"}, "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
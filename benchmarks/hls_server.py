@@ -0,0 +1,193 @@
+"""
+Local HLS stand-in for the benchmarks: a master playlist with two variants,
+a media playlist of synthetic segments, optional AES-128, and knobs for
+per-request latency, injected errors and a shared bandwidth cap.
+"""
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TS_PACKET = 188
+KEY = bytes(range(16))
+
+
+def synthetic_segment(size):
+    """ MPEG-TS null packets: right shape on the wire, but nothing ffmpeg can mux """
+    packet = b"\x47\x1f\xff\x10" + b"\xff" * (TS_PACKET - 4)
+    return (packet * (size // TS_PACKET + 1))[:size]
+
+
+def ffmpeg_segment(ffmpeg, size, duration):
+    """ One real MPEG-2 video segment of roughly `size` bytes, so the mux step can be timed too """
+    bitrate = int(size * 8 / duration)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "seg.ts")
+        subprocess.run([
+            ffmpeg, "-y", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc2=size=640x360:rate=25:duration={duration}",
+            "-c:v", "mpeg2video", "-b:v", str(bitrate), "-minrate", str(bitrate),
+            "-maxrate", str(bitrate), "-bufsize", str(bitrate), "-f", "mpegts", path
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class TokenBucket:
+    """ Bytes/s cap shared by every connection to the server """
+
+    def __init__(self, rate):
+        self.rate = rate
+        # Room for at least one write, or a cap below the write size would never pass
+        self.capacity = max(rate, 65536)
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HLSServer:
+    """
+    Serves /master.m3u8, /media.m3u8, /segNNNNN.ts and /key.bin on 127.0.0.1.
+    Each segment request is timed from arrival to last byte sent; the
+    timings are what the benchmark reports as segment latency.
+    """
+
+    def __init__(self, segments=100, segment_size=256 * 1024, duration=2.0, encrypted=False,
+                 latency=0.0, error_rate=0.0, bandwidth=0, ffmpeg=None, seed=1):
+        self.segments = segments
+        self.duration = duration
+        self.encrypted = encrypted
+        self.latency = latency
+        self.error_rate = error_rate
+        self.bucket = TokenBucket(bandwidth) if bandwidth else None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.timings = []
+        self.errors = 0
+
+        if ffmpeg and shutil.which(ffmpeg):
+            payload = ffmpeg_segment(ffmpeg, segment_size, duration)
+            self.real_media = True
+        else:
+            payload = synthetic_segment(segment_size)
+            self.real_media = False
+        if encrypted:
+            from Crypto.Cipher import AES
+
+            pad = 16 - len(payload) % 16
+            payload += bytes([pad]) * pad
+            # Every segment uses the same explicit IV, so one ciphertext serves them all
+            payload = AES.new(KEY, AES.MODE_CBC, bytes(16)).encrypt(payload)
+        self.payload = payload
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}/master.m3u8"
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.timings = []
+            self.errors = 0
+
+    def master_playlist(self):
+        return "\n".join([
+            "#EXTM3U",
+            "#EXT-X-STREAM-INF:BANDWIDTH=400000,RESOLUTION=640x360",
+            "media.m3u8",
+            f"#EXT-X-STREAM-INF:BANDWIDTH={int(len(self.payload) * 8 / self.duration)},RESOLUTION=1280x720",
+            "media.m3u8",
+            ""
+        ])
+
+    def media_playlist(self):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{int(self.duration + 0.999)}",
+                 "#EXT-X-MEDIA-SEQUENCE:0"]
+        if self.encrypted:
+            lines.append('#EXT-X-KEY:METHOD=AES-128,URI="key.bin",IV=0x' + "0" * 32)
+        for i in range(self.segments):
+            lines += [f"#EXTINF:{self.duration:.3f},", f"seg{i:05d}.ts"]
+        lines += ["#EXT-X-ENDLIST", ""]
+        return "\n".join(lines)
+
+    def _inject_error(self):
+        with self._lock:
+            failed = self.error_rate and self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return failed
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body, content_type):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if server.bucket:
+                    for offset in range(0, len(body), 16384):
+                        chunk = body[offset:offset + 16384]
+                        server.bucket.take(len(chunk))
+                        self.wfile.write(chunk)
+                else:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/master.m3u8":
+                    return self._send(server.master_playlist().encode(), "application/vnd.apple.mpegurl")
+                if path == "/media.m3u8":
+                    return self._send(server.media_playlist().encode(), "application/vnd.apple.mpegurl")
+                if path == "/key.bin":
+                    return self._send(KEY, "application/octet-stream")
+                if path.startswith("/seg") and path.endswith(".ts"):
+                    start = time.monotonic()
+                    if server.latency:
+                        time.sleep(server.latency)
+                    if server._inject_error():
+                        self.send_response(503)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self._send(server.payload, "video/mp2t")
+                    with server._lock:
+                        server.timings.append(time.monotonic() - start)
+                    return
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        return Handler
@@ -0,0 +1,80 @@
+from urllib.parse import urljoin
+
+
+def parse_byterange(value, default_offset=0):
+    """ '1024@2048' -> (2048, 1024); a missing offset continues from default_offset """
+    length, _, offset = value.partition("@")
+    return (int(offset) if offset else default_offset), int(length)
+
+
+def segment_entries(segments, base_url, first_index=0, next_offset=None):
+    """
+    [(index, url, (start, length) or None)] for a list of m3u8 segments.
+    EXT-X-BYTERANGE without an offset starts where the previous range of the
+    same resource ended, so that position is tracked per URL; pass the same
+    next_offset dict to carry on from an earlier call on the segments before.
+    """
+    entries = []
+    next_offset = {} if next_offset is None else next_offset
+    for i, seg in enumerate(segments, first_index):
+        url = seg.absolute_uri or urljoin(base_url, seg.uri)
+        rng = None
+        if seg.byterange:
+            rng = parse_byterange(seg.byterange, next_offset.get(url, 0))
+            next_offset[url] = rng[0] + rng[1]
+        entries.append((i, url, rng))
+    return entries
+
+
+def build_jobs(entries, max_bytes=8 * 1024 * 1024, parallelism=1):
+    """
+    Turn segment entries into fetch jobs (first_index, url, ranges).
+    ranges is None for a plain segment, otherwise [(index, start, length), ...]:
+    consecutive segments that are back-to-back ranges of the same resource are
+    merged into one Range request of at most max_bytes. The cap also shrinks so
+    there are still enough requests to keep `parallelism` connections busy.
+    """
+    ranged_bytes = sum(rng[1] for _, _, rng in entries if rng)
+    if ranged_bytes:
+        max_bytes = max(1, min(max_bytes, -(-ranged_bytes // parallelism)))
+
+    jobs = []
+    for i, url, rng in entries:
+        if rng is None:
+            jobs.append((i, url, None))
+            continue
+
+        start, length = rng
+        if jobs:
+            last_i, last_url, last_ranges = jobs[-1]
+            if last_ranges and last_url == url:
+                prev_index, prev_start, prev_length = last_ranges[-1]
+                group_start = last_ranges[0][1]
+                contiguous = prev_index + 1 == i and prev_start + prev_length == start
+                if contiguous and start + length - group_start <= max_bytes:
+                    last_ranges.append((i, start, length))
+                    continue
+        jobs.append((i, url, [(i, start, length)]))
+    return jobs
+
+
+def range_header(ranges):
+    start = ranges[0][1]
+    last_index, last_start, last_length = ranges[-1]
+    return {"Range": f"bytes={start}-{last_start + last_length - 1}"}
+
+
+def split_ranges(data, ranges, status):
+    """
+    Cut the body of a (coalesced) range response back into (index, bytes) pieces.
+    A server that ignores Range answers 200 with the whole resource, so slice that.
+    """
+    # A 206 body starts at the first range; a 200 body starts at byte 0
+    origin = ranges[0][1] if status == 206 else 0
+    pieces = []
+    for index, start, length in ranges:
+        piece = data[start - origin:start - origin + length]
+        if len(piece) != length:
+            raise Exception(f"Short byte-range response for segment {index}")
+        pieces.append((index, piece))
+    return pieces
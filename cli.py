@@ -0,0 +1,199 @@
+# cli.py
+"""
+Headless downloads without the GUI. Imports nothing from Tk or plyer, so it
+runs on servers without a display.
+
+    python cli.py URL [-n NAME]
+    python cli.py -i jobs.txt          # one "URL [name]" per line
+
+Progress is printed to stdout as JSON lines. Exit status: 0 when every
+download succeeded, 1 when any failed, 2 for bad arguments and 130 when
+interrupted (finished segments are kept so the same command resumes).
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+from downloader import DownloadWorker, OUTPUT_EXTENSIONS
+from progress import ProgressAggregator, REFRESH_INTERVAL
+from settings import load_settings, store as settings_store, VALID_THREADS, MIN_PARALLEL, MAX_PARALLEL
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_INTERRUPTED = 130
+
+
+def emit(event, **fields):
+    print(json.dumps({"event": event, "time": round(time.time(), 3), **fields}), flush=True)
+
+
+def default_name(url):
+    """
+    The playlist's file name plus a short suffix, like the GUI's, but taken
+    from a hash of the URL so that rerunning the same command finds the
+    segments of the interrupted run.
+    """
+    parsed = urllib.parse.urlparse(url)
+    base = os.path.basename(parsed.path)
+    name = os.path.splitext(base)[0] or parsed.netloc or "video"
+    name = name.strip()[:30].replace(" ", "_") or "video"
+    return name + "_" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:6]
+
+
+def read_jobs(path):
+    """ [(url, name or None)] from a file of "URL [name]" lines; blank lines and # comments are skipped """
+    jobs = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            url, _, name = line.partition(" ")
+            jobs.append((url, name.strip() or None))
+    return jobs
+
+
+def unique_names(jobs, output_dir):
+    """ Fill in missing names and keep them clear of each other and of finished files """
+    taken = set()
+    named = []
+    for url, raw_name in jobs:
+        raw_name = raw_name or default_name(url)
+        name = raw_name
+        counter = 1
+        while name in taken or any(os.path.exists(os.path.join(output_dir, name + ext)) for ext in OUTPUT_EXTENSIONS):
+            name = f"{raw_name}_{counter}"
+            counter += 1
+        taken.add(name)
+        named.append((url, name))
+    return named
+
+
+class BatchRunner:
+    """ Runs jobs with at most max_parallel DownloadWorkers alive at once """
+
+    def __init__(self, jobs, output_dir, max_parallel, num_connections):
+        self.pending = list(jobs)
+        self.output_dir = output_dir
+        self.max_parallel = max_parallel
+        self.num_connections = num_connections
+        self.running = {}
+        self.results = {}
+        self.progress = ProgressAggregator()
+        self._done = []
+        self._lock = threading.Lock()
+
+    def _on_done(self, name, success, msg):
+        with self._lock:
+            self._done.append((name, success, msg))
+
+    def _start_next(self):
+        while self.pending and len(self.running) < self.max_parallel:
+            url, name = self.pending.pop(0)
+            worker = DownloadWorker(
+                name=name,
+                url=url,
+                output_dir=self.output_dir,
+                progress_callback=self.progress.publish,
+                done_callback=self._on_done,
+                num_connections=self.num_connections
+            )
+            self.running[name] = worker
+            emit("start", name=name, url=url)
+            worker.start()
+
+    def _flush(self):
+        for name, (percent, downloaded_mb, estimated_mb, speed, connections, eta) in self.progress.drain().items():
+            emit("progress", name=name, percent=round(percent, 2), downloaded_mb=round(downloaded_mb, 2),
+                 estimated_mb=round(estimated_mb, 2), speed_mbps=round(speed, 3), connections=connections,
+                 eta=round(eta, 1) if eta is not None else None)
+
+        with self._lock:
+            done, self._done = self._done, []
+        for name, success, msg in done:
+            self.progress.discard(name)
+            worker = self.running.pop(name, None)
+            self.results[name] = success
+            emit("done", name=name, ok=success, message=msg, summary=worker.metrics.summary() if worker else [])
+
+    def run(self):
+        self._start_next()
+        while self.running:
+            time.sleep(REFRESH_INTERVAL)
+            self._flush()
+            # Edits to the settings file (timeout, max_retries...) reach the running workers
+            settings_store.poll()
+            self._start_next()
+        return all(self.results.values())
+
+    def interrupt(self):
+        """ Cancel running jobs but keep their journaled segments for the next run """
+        for worker in self.running.values():
+            worker.cancel(keep_segments=True)
+        self.pending.clear()
+        while self.running:
+            time.sleep(REFRESH_INTERVAL)
+            self._flush()
+
+
+def main(argv=None):
+    settings = load_settings()
+
+    parser = argparse.ArgumentParser(description="Download M3U8/HLS streams without the GUI.")
+    parser.add_argument("url", nargs="?", help="M3U8 URL to download")
+    parser.add_argument("-n", "--name", help="Output name (no .mp4); only with a single URL")
+    parser.add_argument("-i", "--input", help="File with one 'URL [name]' per line")
+    parser.add_argument("-o", "--output-dir", default=settings.get("output_dir") or os.getcwd(),
+                        help="Folder for the finished videos (default: settings output_dir)")
+    parser.add_argument("-j", "--parallel", type=int, default=settings.get("max_parallel", 5),
+                        choices=range(MIN_PARALLEL, MAX_PARALLEL + 1), metavar=f"{{{MIN_PARALLEL}-{MAX_PARALLEL}}}",
+                        help="Downloads running at once (default: settings max_parallel)")
+    parser.add_argument("-c", "--connections", type=int, default=settings.get("num_connections", 8),
+                        choices=VALID_THREADS, help="Connections per download (default: settings num_connections)")
+    args = parser.parse_args(argv)
+
+    if bool(args.url) == bool(args.input):
+        parser.print_usage(sys.stderr)
+        print("error: give either a URL or --input", file=sys.stderr)
+        return EXIT_USAGE
+    if args.name and not args.url:
+        print("error: --name only applies to a single URL", file=sys.stderr)
+        return EXIT_USAGE
+
+    output_dir = args.output_dir.strip()
+    if not os.path.isdir(output_dir) or not os.access(output_dir, os.W_OK):
+        print(f"error: output folder is not valid or writable: {output_dir}", file=sys.stderr)
+        return EXIT_USAGE
+
+    if args.input:
+        try:
+            jobs = read_jobs(args.input)
+        except OSError as e:
+            print(f"error: cannot read {args.input}: {e}", file=sys.stderr)
+            return EXIT_USAGE
+        if not jobs:
+            print(f"error: no URLs in {args.input}", file=sys.stderr)
+            return EXIT_USAGE
+    else:
+        jobs = [(args.url, args.name)]
+
+    runner = BatchRunner(unique_names(jobs, output_dir), output_dir, args.parallel, args.connections)
+    try:
+        ok = runner.run()
+    except KeyboardInterrupt:
+        runner.interrupt()
+        emit("summary", ok=False, interrupted=True, results=runner.results)
+        return EXIT_INTERRUPTED
+
+    emit("summary", ok=ok, interrupted=False, results=runner.results)
+    return EXIT_OK if ok else EXIT_FAILED
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+import threading
+import time
+
+# Responses that mean the origin wants us to back off
+THROTTLE_STATUSES = (429, 503)
+
+
+class AimdController:
+    """
+    Adjustable in-flight request limit for one download (additive increase,
+    multiplicative decrease). Each measurement window lasts about `limit`
+    completions: if throughput improved, allow one more request in flight;
+    429/503 responses or a high error rate halve the limit.
+    With minimum == maximum it is just a fixed-size slot pool.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None, error_threshold=0.2, min_window=1.0):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum or initial)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.error_threshold = error_threshold
+        self.min_window = min_window
+
+        self.inflight = 0
+        self._cond = threading.Condition()
+        self._reset_window(time.monotonic())
+        self._last_rate = 0.0
+        self._last_decrease = 0.0
+
+    @property
+    def adaptive(self):
+        return self.minimum != self.maximum
+
+    def _reset_window(self, now):
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_ok = 0
+        self._window_errors = 0
+
+    def try_acquire(self):
+        with self._cond:
+            if self.inflight < self.limit:
+                self.inflight += 1
+                return True
+            return False
+
+    def acquire(self, should_stop):
+        """ Block until a slot is free; returns False if should_stop() became true first """
+        with self._cond:
+            while self.inflight >= self.limit:
+                if should_stop():
+                    return False
+                self._cond.wait(0.5)
+            self.inflight += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.inflight = max(0, self.inflight - 1)
+            self._cond.notify()
+
+    def on_success(self, nbytes):
+        if not self.adaptive:
+            return
+        with self._cond:
+            self._window_ok += 1
+            self._window_bytes += nbytes
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            if self._window_ok < self.limit or elapsed < self.min_window:
+                return
+
+            rate = self._window_bytes / elapsed
+            if rate >= self._last_rate * 1.05 and self.limit < self.maximum:
+                # Still scaling: probe one more connection
+                self.limit += 1
+                self._cond.notify()
+            elif rate < self._last_rate * 0.75 and self.limit > self.minimum:
+                # More connections made things slower, step back
+                self.limit -= 1
+            self._last_rate = rate
+            self._reset_window(now)
+
+    def on_error(self, status=None):
+        if not self.adaptive:
+            return
+        with self._cond:
+            self._window_errors += 1
+            now = time.monotonic()
+            total = self._window_ok + self._window_errors
+            throttled = status in THROTTLE_STATUSES
+            too_many_errors = total >= 5 and self._window_errors / total >= self.error_threshold
+            # One decrease per window so a burst of failures doesn't collapse to 1 at once
+            if (throttled or too_many_errors) and now - self._last_decrease >= self.min_window:
+                self.limit = max(self.minimum, self.limit // 2)
+                self._last_decrease = now
+                self._last_rate = 0.0
+                self._reset_window(now)
@@ -0,0 +1,90 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from settings import store as settings
+
+
+class CpuPool:
+    """
+    Process-wide stage for the CPU side of saving a segment (decrypt, verify,
+    write), so it doesn't compete with socket reads on the network threads.
+    Its size follows the cores, not the connection count. A task needs a slot,
+    and there are `depth` of them across every download: once they're all
+    queued or running, fetchers wait in acquire() instead of piling fetched
+    bodies up in memory. pycryptodome drops the GIL while it decrypts, so
+    threads are enough to spread the work over the cores.
+    """
+
+    def __init__(self, workers=0, depth=0):
+        self.workers = workers or os.cpu_count() or 4
+        self.depth = depth or self.workers * 4
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="cpu")
+        self._cond = threading.Condition()
+        self._used = 0
+
+    def resize(self, workers=0, depth=0):
+        workers = workers or os.cpu_count() or 4
+        with self._cond:
+            if workers != self.workers:
+                # Queued tasks finish on the old pool; new ones go to the new one
+                old, self._pool = self._pool, ThreadPoolExecutor(workers, thread_name_prefix="cpu")
+                old.shutdown(wait=False)
+                self.workers = workers
+            self.depth = depth or workers * 4
+            self._cond.notify_all()
+
+    def _try_take(self):
+        if self._used >= self.depth:
+            return False
+        self._used += 1
+        return True
+
+    def acquire(self, should_stop):
+        """ Block until a slot is free; returns False if should_stop() became true first """
+        with self._cond:
+            while not self._try_take():
+                if should_stop():
+                    return False
+                self._cond.wait(0.5)
+            return True
+
+    async def acquire_async(self, should_stop):
+        """ acquire() for the event loop: polls instead of blocking it """
+        while True:
+            with self._cond:
+                if self._try_take():
+                    return True
+            if should_stop():
+                return False
+            await asyncio.sleep(0.02)
+
+    def release(self):
+        with self._cond:
+            self._used = max(0, self._used - 1)
+            self._cond.notify_all()
+
+    def submit(self, fn, *args):
+        """ Run fn(*args) in the pool on a slot taken with acquire(); the slot is freed when it ends """
+        with self._cond:
+            pool = self._pool
+        future = pool.submit(fn, *args)
+        future.add_done_callback(lambda f: self.release())
+        return future
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_cpu_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = CpuPool(settings.get("cpu_workers", 0), settings.get("cpu_queue_depth", 0))
+            settings.subscribe(_apply_settings)
+        return _pool
+
+
+def _apply_settings(new_settings):
+    _pool.resize(new_settings["cpu_workers"], new_settings["cpu_queue_depth"])
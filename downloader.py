@@ -1,16 +1,49 @@
 import threading
-import requests
 import os
 import time
-import m3u8
 import subprocess
 import shutil
-import sys
-from urllib.parse import urljoin
+import zlib
+from urllib.parse import urljoin, urlparse
 from queue import Queue, Empty
-from settings import load_settings
+from collections import deque
+from concurrent.futures import wait
+from settings import store as settings
+from http_pool import get_session, load_playlist, refresh_playlist, conditional_headers
+from muxer import StreamMuxer, NativeStreamMuxer, concat_segments, ffmpeg_startupinfo
+from journal import SegmentJournal
+from segment_store import SegmentStore
+from concurrency import AimdController
+from scheduler import get_scheduler
+from keys import KeyManager, DecryptionError, segment_key
+from streaming import StreamingSegment, CHUNK_SIZE
+from byterange import segment_entries, build_jobs, range_header, split_ranges, parse_byterange
+from variants import select_variant, fit_variant, probe_throughput, ranked, variant_url
+from progress import EwmaRate
+from metrics import JobMetrics, get_registry, error_cause
+from retry import RetryPolicy, get_breaker, FATAL
+from sources import resolve_sources
+from cpu_pool import get_cpu_pool
+from segment_cache import get_segment_cache, segment_validators
+from ratelimit import TokenBucket, get_bandwidth_limiter, kbs_rate
 
-settings = load_settings()
+# Segments timed by the fit_throughput variant policy
+PROBE_SEGMENTS = 4
+
+# Segment containers that can be joined byte for byte into a playable file of the same type
+NATIVE_EXTENSIONS = [".ts", ".aac"]
+# Every extension a finished download can have
+OUTPUT_EXTENSIONS = [".mp4", *NATIVE_EXTENSIONS]
+
+# Anything shorter is treated as a broken response (arbitrary minimal threshold)
+MIN_SEGMENT_BYTES = 128
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
 
 class DownloadWorker(threading.Thread):
     def __init__(self, name, url, output_dir, progress_callback, done_callback, num_connections=8):
@@ -19,8 +52,10 @@ class DownloadWorker(threading.Thread):
         self.url = url
         self.output_dir = output_dir
         self.progress_callback = progress_callback
-        self.done_callback = done_callback
-        
+        self._done_callback = done_callback
+        # Phase timings, retries and error causes, exported when the job ends
+        self.metrics = JobMetrics(name)
+
         # ✅ Validate num_connections
         allowed_threads = [1, 2, 4, 8, 16, 32]
         self.num_connections = num_connections if num_connections in allowed_threads else 8
@@ -28,9 +63,58 @@ class DownloadWorker(threading.Thread):
         self._pause = threading.Event()
         self._pause.set()
         self._cancel = False
+        self._error = None
         self.segment_dir = None
+        # Every segment of the job in one file, plus its (offset, length) index
+        self.store = None
+        self.muxer = None
+        self.journal = None
+        self.keys = None
+        # Equivalent playlists on other variants/mirrors to spread segment requests over, if any
+        self.sources = None
+        self._keep_segments = False
+        self._stop_live = threading.Event()
+        self.live = False
+        self.skipped = set()
+        # Segment jobs for both engines; closed once no more will be added
+        self.jobs = Queue()
+        self._jobs_closed = threading.Event()
+        # Jobs being fetched (first index -> [attempt start, url, ranges, hedged]) and
+        # jobs already saved by one of possibly two racing requests
+        self._inflight = {}
+        self._claimed = set()
+        self._fetch_times = deque(maxlen=256)
+        self._hedge_lock = threading.Lock()
+        self.hedging = settings.get("hedge_requests", True)
         self.timeout = settings.get("timeout", 10)
         self.max_retries = settings.get("max_retries", 3)
+        self.retry_policy = RetryPolicy(settings.get("retry_base_delay", 0.5), settings.get("retry_max_delay", 30))
+        self.engine = settings.get("engine", "threads")
+
+        # In-flight request limit; starts at num_connections and, if adaptive, moves with the origin's behaviour
+        if settings.get("adaptive_connections", False):
+            self.controller = AimdController(self.num_connections, minimum=1, maximum=settings.get("max_connections", 64))
+        else:
+            self.controller = AimdController(self.num_connections, minimum=self.num_connections, maximum=self.num_connections)
+
+        # Global/per-host budget shared with every other running download
+        self.scheduler = get_scheduler()
+        # Decrypt/write stage shared with every other download; tasks still queued for this job
+        self.cpu_pool = get_cpu_pool()
+        # Set while the async engine runs a save step on its loop thread with a pool slot already taken
+        self._slot_taken = threading.local()
+        self._staged = set()
+        self._staged_lock = threading.Lock()
+        # Bodies of earlier jobs, by segment URL; (url, byte range) of every job index to look them up by
+        self.cache = get_segment_cache()
+        self.cache_revalidate = settings.get("cache_revalidate", False)
+        self._cache_keys = {}
+        # Every chunk read is paid for in the global bucket and in this job's own
+        self.bandwidth = get_bandwidth_limiter()
+        self.job_bandwidth = TokenBucket(kbs_rate(settings.get("job_max_download_kbs", 0)))
+
+        # Keep-alive pool shared by every worker, sized so each parallel job can hold all its connections
+        self.session = get_session(self.controller.maximum * settings.get("max_parallel", 5))
         self.daemon = True
 
     def pause(self):
@@ -39,53 +123,137 @@ class DownloadWorker(threading.Thread):
     def resume(self):
         self._pause.set()
 
-    def cancel(self):
+    def cancel(self, keep_segments=False):
+        # keep_segments leaves the journaled segment folder behind so the job can resume later
+        self._keep_segments = keep_segments
         self._cancel = True
         self._pause.set()
 
+    def stop(self):
+        """ End a live capture: stop refreshing, finish queued segments and mux what was recorded """
+        self._stop_live.set()
+        self._pause.set()
+
+    def _fail(self, msg):
+        # First error wins; every connection stops picking up new segments
+        if not self._error:
+            self._error = msg
+
+    @property
+    def stopped(self):
+        return self._cancel or self._error is not None
+
+    @property
+    def jobs_drained(self):
+        return self._jobs_closed.is_set() and self.jobs.empty()
+
+    def done_callback(self, name, success, msg):
+        """ Close the job's metrics, then hand the result to the caller's done_callback """
+        result = "ok" if success else "cancelled" if self._cancel else "failed"
+        self.metrics.finish(result)
+        get_registry().record_job(self.metrics)
+        self._done_callback(name, success, msg)
+
+    def _apply_settings(self, new_settings):
+        # Pushed by the settings store when the file changes; picked up by the next request
+        self.timeout = new_settings["timeout"]
+        self.max_retries = new_settings["max_retries"]
+        self.retry_policy = RetryPolicy(new_settings["retry_base_delay"], new_settings["retry_max_delay"])
+        self.hedging = new_settings["hedge_requests"]
+        self.cache_revalidate = new_settings["cache_revalidate"]
+        self.job_bandwidth.set_rate(kbs_rate(new_settings["job_max_download_kbs"]))
+        if self.keys:
+            self.keys.timeout = self.timeout
+
     def run(self):
+        settings.subscribe(self._apply_settings)
         try:
             if not os.access(self.output_dir, os.W_OK):
                 self.done_callback(self.name, False, "Output folder not writable.")
                 return
 
-            playlist = m3u8.load(self.url)
-            if playlist.is_variant and playlist.playlists:
-                playlist = m3u8.load(urljoin(self.url, playlist.playlists[0].uri))
+            segment_dir = os.path.join(self.output_dir, f"{self.name}_segments")
+            self.journal = SegmentJournal(segment_dir)
+            manifest = self.journal.load()
+            if manifest and manifest.get("url") != self.url:
+                manifest = None
+
+            master = None
+            if manifest:
+                # ✅ Resuming: reuse last run's variant so segment indices still line up
+                media_url = manifest["variant_url"]
+                playlist = load_playlist(media_url, timeout=self.timeout, lazy=True)
+            else:
+                media_url = self.url
+                playlist = load_playlist(self.url, timeout=self.timeout, lazy=True)
+                if playlist.is_variant and playlist.playlists:
+                    master = playlist
+                    media_url, media_playlist = self._choose_variant(playlist)
+                    playlist = media_playlist or load_playlist(media_url, timeout=self.timeout, lazy=True)
 
+            # Only the first batch of segments is parsed before downloading starts
+            batches = iter(()) if playlist.is_variant else playlist.parse()
+            next(batches, None)
             segments = playlist.segments
             if not segments:
                 self.done_callback(self.name, False, "No segments found.")
                 return
 
+            # No #EXT-X-ENDLIST yet: a live or EVENT stream that keeps growing
+            self.live = not playlist.is_endlist
+            if self.live:
+                # The refresher carries on from the end of the current window
+                for _ in batches:
+                    pass
+
             ext = os.path.splitext(segments[0].uri)[1]
-            segment_ext = ext if ext.lower() in [".ts", ".aac", ".mp4"] else ".ts"
-            self.segment_dir = os.path.join(self.output_dir, f"{self.name}_segments")
-            os.makedirs(self.segment_dir, exist_ok=True)
-
-            key = None
-            iv = None
-            if playlist.keys and playlist.keys[0]:
-                key_uri = playlist.keys[0].uri
-                if key_uri:
-                    try:
-                        key_url = urljoin(playlist.base_uri or self.url, key_uri)
-                        key = requests.get(key_url, timeout=self.timeout).content
-                        iv = playlist.keys[0].iv
-                    except Exception as e:
-                        self.done_callback(self.name, False, f"Failed to download AES key: {e}")
-                        return
+            self.segment_ext = ext if ext.lower() in [".ts", ".aac", ".mp4", ".m4s"] else ".ts"
+            self.ffmpeg = settings.get("ffmpeg_path", "ffmpeg")
+
+            self.first_sequence = playlist.media_sequence or 0
+            self.keys = KeyManager(self.session, self.timeout, manifest.get("keys") if manifest else None)
+            self.segment_keys = {}
+            self._map_keys(segments, self.first_sequence, media_url)
+            try:
+                # Every distinct key up front: a bad key fails the job before any segment is fetched
+                for key_url in {k[0] for k in self.segment_keys.values() if k}:
+                    self.keys.get(key_url)
+            except Exception as e:
+                self.done_callback(self.name, False, f"Failed to download AES key: {e}")
+                return
+
+            self.segment_inits = {}
+            self._init_cache = {}
+            try:
+                self._map_inits(segments, self.first_sequence, media_url)
+            except Exception as e:
+                self.done_callback(self.name, False, f"Failed to download init segment: {e}")
+                return
 
-            queue = Queue()
-            for i, seg in enumerate(segments):
-                segment_url = seg.absolute_uri or urljoin(self.url, seg.uri)
-                queue.put((i, segment_url))
+            # ffmpeg is only needed to change the container: fMP4 already is MP4, and
+            # TS/AAC are kept as they are when output_format is "native"
+            if self.segment_inits:
+                self.native, output_ext = True, ".mp4"
+            elif settings.get("output_format", "mp4") == "native" and self.segment_ext.lower() in NATIVE_EXTENSIONS:
+                self.native, output_ext = True, self.segment_ext.lower()
+            else:
+                self.native, output_ext = False, ".mp4"
+            self.output_path = os.path.join(self.output_dir, f"{self.name}{output_ext}")
 
-            total = queue.qsize()
+            # Known before the rest of a long playlist is parsed; corrected once it is
+            self.total = max(len(segments), playlist.segment_count)
             self.downloaded = 0
             self.downloaded_bytes = 0
-            start_time = time.time()
-            threads = []
+            self.start_time = time.time()
+            self._progress_lock = threading.Lock()
+            # Smoothed download speed, and media seconds fetched per second for the ETA
+            self._byte_rate = EwmaRate()
+            self._media_rate = EwmaRate()
+            # Filled in by _queue_segments as segments are parsed
+            self.durations = {}
+            self.total_seconds = 0.0
+            self.downloaded_seconds = 0.0
+            self._next_offset = {}
 
             try:
                 from Crypto.Cipher import AES
@@ -93,114 +261,835 @@ class DownloadWorker(threading.Thread):
                 self.done_callback(self.name, False, "Missing dependency: pycryptodome. Install via 'pip install pycryptodome'")
                 return
 
-            def worker():
-                while not queue.empty() and not self._cancel:
-                    self._pause.wait()
-                    if self._cancel:
+            store = SegmentStore(segment_dir, None if self.live else self.total)
+            resumed = {}
+            if manifest and not self.live and manifest.get("total") == self.total and manifest.get("segment_ext") == self.segment_ext:
+                resumed = self.journal.completed(store.path)
+
+            if settings.get("stream_mux", False) and not resumed:
+                # ✅ Pipelined mode: segments go straight into the output (or ffmpeg), nothing is staged on disk
+                total = None if self.live else self.total
+                # A folder from an earlier run with nothing verified in it would only be restored again and again
+                shutil.rmtree(segment_dir, ignore_errors=True)
+                if self.native:
+                    self.muxer = NativeStreamMuxer(None, self.output_path, total, self.num_connections * 4, self.segment_inits)
+                else:
+                    if not shutil.which(self.ffmpeg):
+                        self.done_callback(self.name, False, f"FFmpeg not found: {self.ffmpeg}")
+                        return
+                    self.muxer = StreamMuxer(self.ffmpeg, self.output_path, total, self.num_connections * 4, self.segment_inits)
+            else:
+                self.segment_dir = segment_dir
+                os.makedirs(self.segment_dir, exist_ok=True)
+                self.store = store
+                self.store.open(resumed)
+            # A live window moves on, so there is nothing meaningful to resume later
+            if self.segment_dir and not self.live:
+                self.journal.start({
+                    "name": self.name,
+                    "url": self.url,
+                    "output_dir": self.output_dir,
+                    "variant_url": media_url,
+                    "keys": self.keys.export(),
+                    "segment_ext": self.segment_ext,
+                    "total": self.total
+                })
+                if resumed:
+                    self.downloaded = len(resumed)
+                    self.downloaded_bytes = sum(length for _, length in resumed.values())
+
+            self._queue_segments(segments, 0, media_url, resumed)
+            if resumed:
+                self._report_progress()
+            if self.live:
+                threading.Thread(target=self._refresh_live, args=(media_url, playlist), daemon=True).start()
+            elif not playlist.parsed:
+                threading.Thread(target=self._parse_rest, args=(batches, master, media_url, playlist, resumed), daemon=True).start()
+            else:
+                self._resolve_sources(master, media_url, playlist)
+                self._jobs_closed.set()
+
+            if self.engine == "asyncio":
+                try:
+                    import async_engine
+                except ImportError:
+                    self._fail("Missing dependency: aiohttp. Install via 'pip install aiohttp'")
+                    self._cleanup()
+                    self.done_callback(self.name, False, self._error)
+                    return
+                async_engine.download_segments(self)
+            else:
+                self._download_threaded()
+            # Segments fetched but still being decrypted/written must land before the mux or cleanup
+            self._drain_cpu_pool()
+
+            if self._cancel:
+                # Only a journaled folder can be resumed; a live or stream_mux job leaves nothing behind
+                if self._keep_segments and self.journal.started:
+                    self.journal.close()
+                    self.store.close()
+                else:
+                    self._cleanup()
+                self.done_callback(self.name, False, "Cancelled")
+                return
+
+            if self._error:
+                self._cleanup()
+                self.done_callback(self.name, False, self._error)
+                return
+
+            self._mux()
+
+        except Exception as e:
+            self._cleanup()
+            self.done_callback(self.name, False, f"Error: {str(e)}")
+        finally:
+            settings.unsubscribe(self._apply_settings)
+            if self.cache:
+                self.cache.save()
+
+    def _choose_variant(self, master):
+        """ Returns (media playlist URL, already loaded playlist or None) for the variant_policy setting """
+        policy = settings.get("variant_policy", "highest")
+        if policy != "fit_throughput":
+            variant = select_variant(master, policy, settings.get("max_resolution"))
+            return variant_url(master, variant, self.url), None
+
+        # Time the first segments of the top rendition, then size every variant against the deadline
+        top_url = variant_url(master, ranked(master)[0], self.url)
+        top_playlist = load_playlist(top_url, timeout=self.timeout)
+        duration = sum(seg.duration or 0 for seg in top_playlist.segments)
+        probes = [seg.absolute_uri for seg in top_playlist.segments[:min(PROBE_SEGMENTS, self.num_connections)]]
+        # The probe runs len(probes) connections in parallel; the download will use num_connections
+        throughput = probe_throughput(self.session, probes, self.timeout) * self.num_connections / max(len(probes), 1)
+
+        variant = fit_variant(master, throughput, duration, settings.get("variant_target_seconds", 600))
+        url = variant_url(master, variant, self.url)
+        return url, top_playlist if url == top_url else None
+
+    def _refresh_live(self, media_url, playlist):
+        """
+        Reload a live media playlist every target duration and queue segments whose
+        media sequence number is new. Ends on #EXT-X-ENDLIST, stop() or a failure.
+        """
+        next_sequence = self.first_sequence + len(playlist.segments)
+        target = playlist.target_duration or 6
+        validators = None
+        failures = 0
+        changed = True
+        try:
+            while not self.stopped:
+                # Per the HLS spec, an unchanged playlist is re-checked after half a target duration
+                if self._stop_live.wait(target if changed else target / 2):
+                    break
+                try:
+                    playlist, validators = refresh_playlist(media_url, timeout=self.timeout, validators=validators)
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    if failures > self.max_retries:
+                        self._fail(f"Live playlist refresh failed: {e}")
                         break
-                    try:
-                        i, segment_url = queue.get_nowait()
-                    except Empty:
+                    changed = False
+                    continue
+
+                changed = False
+                if playlist is None:  # 304 Not Modified
+                    continue
+                target = playlist.target_duration or target
+                sequence = playlist.media_sequence or 0
+                self._map_keys(playlist.segments, sequence, media_url)
+                try:
+                    self._map_inits(playlist.segments, sequence, media_url)
+                except Exception as e:
+                    self._fail(f"Failed to download init segment: {e}")
+                    break
+                for seq, segment_url, rng in segment_entries(playlist.segments, media_url, playlist.media_sequence or 0):
+                    if seq < next_sequence:
                         continue
+                    # Segments that left the window before we saw them are gone for good
+                    for missed in range(next_sequence, seq):
+                        self._skip_segment(missed - self.first_sequence)
+                    i = seq - self.first_sequence
+                    duration = playlist.segments[seq - (playlist.media_sequence or 0)].duration or 0
+                    with self._progress_lock:
+                        self.durations[i] = duration
+                        self.total_seconds += duration
+                    self._cache_keys[i] = (segment_url, rng)
+                    self.jobs.put((i, segment_url, [(i, *rng)] if rng else None))
+                    next_sequence = seq + 1
+                    changed = True
+                with self._progress_lock:
+                    self.total = next_sequence - self.first_sequence
+                if playlist.is_endlist:
+                    break
+        finally:
+            self._jobs_closed.set()
 
-                    retry = 0
-                    while retry <= self.max_retries:
-                        if self._cancel:
-                            break
-                        self._pause.wait()
+    def _parse_rest(self, batches, master, media_url, playlist, resumed):
+        """ Parse the rest of a long VOD playlist, queueing each batch of segments as it is read """
+        try:
+            for first, segments in batches:
+                if self.stopped:
+                    break
+                self._map_keys(segments, self.first_sequence + first, media_url)
+                try:
+                    for key_url in {self.segment_keys[i][0] for i in range(first, first + len(segments)) if self.segment_keys[i]}:
+                        self.keys.get(key_url)
+                except Exception as e:
+                    self._fail(f"Failed to download AES key: {e}")
+                    break
+                try:
+                    self._map_inits(segments, self.first_sequence + first, media_url)
+                except Exception as e:
+                    self._fail(f"Failed to download init segment: {e}")
+                    break
+                self._queue_segments(segments, first, media_url, resumed)
+            else:
+                with self._progress_lock:
+                    self.total = len(playlist.segments)
+                self._resolve_sources(master, media_url, playlist)
+        except Exception as e:
+            self._fail(f"Error: {e}")
+        finally:
+            self._jobs_closed.set()
+
+    def _queue_segments(self, segments, first, media_url, resumed):
+        """ Queue fetch jobs for segments, the playlist's segments from index first on """
+        entries = segment_entries(segments, media_url, first, self._next_offset)
+        with self._progress_lock:
+            for (i, url, rng), seg in zip(entries, segments):
+                self.durations[i] = seg.duration or 0
+                self.total_seconds += self.durations[i]
+                if i in resumed:
+                    self.downloaded_seconds += self.durations[i]
+                self._cache_keys[i] = (url, rng)
+        if resumed:
+            entries = [entry for entry in entries if entry[0] not in resumed]
+        for job in build_jobs(entries, settings.get("max_range_bytes", 8 * 1024 * 1024), self.num_connections):
+            self.jobs.put(job)
+
+    def _resolve_sources(self, master, media_url, playlist):
+        # A live window moves differently on every source, so only VOD is spread out
+        if not self.live and settings.get("multi_source", True):
+            self.sources = resolve_sources(master, media_url, playlist, settings.get("mirrors", []), self.url, self.timeout)
+
+    def _map_keys(self, segments, sequence, media_url):
+        """ Record which key and IV decrypt each segment, by job index; sequence is that of segments[0] """
+        for seq, seg in enumerate(segments, sequence):
+            i = seq - self.first_sequence
+            if i >= 0 and i not in self.segment_keys:
+                self.segment_keys[i] = segment_key(seg, seq, media_url)
+
+    def _map_inits(self, segments, sequence, media_url):
+        """ Fetch each EXT-X-MAP init segment once and record which one every job index follows """
+        for seq, seg in enumerate(segments, sequence):
+            i = seq - self.first_sequence
+            init = seg.init_section
+            if i < 0 or i in self.segment_inits or not init:
+                continue
+            url = init.absolute_uri or urljoin(media_url, init.uri)
+            if (url, init.byterange) not in self._init_cache:
+                headers = None
+                if init.byterange:
+                    start, length = parse_byterange(init.byterange)
+                    headers = range_header([(i, start, length)])
+                r = self.session.get(url, timeout=self.timeout, headers=headers)
+                if r.status_code not in ((200, 206) if headers else (200,)):
+                    raise HTTPStatusError(r.status_code)
+                data = r.content
+                if headers and r.status_code == 200:
+                    data = data[start:start + length]
+                self._init_cache[(url, init.byterange)] = data
+            self.segment_inits[i] = self._init_cache[(url, init.byterange)]
+
+    def _skip_segment(self, i):
+        self.skipped.add(i)
+        if self.muxer:
+            self.muxer.feed(i, b"")
+
+    def _download_threaded(self):
+        queue = self.jobs
+
+        def worker():
+            while not self.stopped:
+                self._pause.wait()
+                if self.stopped:
+                    break
+                try:
+                    i, segment_url, ranges = queue.get(timeout=0.2)
+                except Empty:
+                    if not self._jobs_closed.is_set():
+                        continue
+                    # Tail of the job: rather than exit, race a duplicate request against a straggler
+                    straggler = self._pick_straggler()
+                    if straggler:
+                        self._hedge(*straggler)
+                    elif not self._inflight:
+                        break
+                    continue
+
+                if self.muxer:
+                    self.muxer.wait_for_room(i, lambda: self.stopped)
+                if self._from_cache(i, ranges):
+                    continue
+
+                # Whole segments headed for disk are streamed; ranges and the stdin muxer need the bytes in memory
+                streaming = not ranges and not self.muxer
+                stream = None
+                source = None
+                retry = 0
+                # Also stop once a hedged duplicate has saved this job
+                while not self.stopped and i not in self._claimed:
+                    self._pause.wait()
+                    source, url = self._route(i, segment_url, source, stream)
+                    host = urlparse(url).netloc
+                    breaker = get_breaker(host)
+                    # An origin that keeps failing is left alone until its breaker lets a probe through
+                    if not breaker.wait(lambda: self.stopped):
+                        break
+                    if not self.controller.acquire(lambda: self.stopped):
+                        breaker.release()
+                        break
+                    if not self.scheduler.acquire(self, host, lambda: self.stopped):
+                        self.controller.release()
+                        breaker.release()
+                        break
+                    self._attempt_started(i, url, ranges)
+                    started = self._source_begin(source)
+                    try:
                         try:
-                            r = requests.get(segment_url, timeout=self.timeout)
-                            if r.status_code != 200:
-                                raise Exception(f"HTTP {r.status_code}")
-                            data = r.content
-                            
-                            if not data or len(data) < 128:  # arbitrary minimal threshold
-                                raise Exception(f"Incomplete segment ({len(data)} bytes)")
-
-                            if key:
-                                try:
-                                    if iv:
-                                        iv_clean = iv[2:] if iv.lower().startswith("0x") else iv
-                                        iv_bytes = bytes.fromhex(iv_clean)
-                                    else:
-                                        iv_bytes = i.to_bytes(16, byteorder='big')
-                                    cipher = AES.new(key, AES.MODE_CBC, iv_bytes)
-                                    data = cipher.decrypt(data)
-                                except Exception as e:
-                                    self.done_callback(self.name, False, f"Decryption failed: {e}")
-                                    return
-
-                                cipher = AES.new(key, AES.MODE_CBC, iv_bytes)
-                                data = cipher.decrypt(data)
-
-                            seg_path = os.path.join(self.segment_dir, f"{i:05d}{segment_ext}")
-                            if os.path.exists(seg_path):
-                                os.remove(seg_path)
-
-                            with open(seg_path, "wb") as f:
-                                f.write(data)
-
-                            self.downloaded += 1
-                            self.downloaded_bytes += len(data)
-                            elapsed = time.time() - start_time + 0.1
-                            speed = self.downloaded_bytes / 1024 / 1024 / elapsed
-                            percent = (self.downloaded / total) * 100
-                            estimated_size = ((self.downloaded_bytes / self.downloaded) * total / 1024 / 1024) if self.downloaded else 0
-
-                            self.progress_callback(self.name, percent, self.downloaded_bytes / 1024 / 1024, estimated_size, speed)
+                            if streaming:
+                                stream = stream or self._open_stream(i)
+                                nbytes = self._fetch_streaming(url, stream, i)
+                            else:
+                                status, data, validators = self._fetch_buffered(url, ranges)
+                                nbytes = len(data)
+                        finally:
+                            self.scheduler.release(self, host)
+                            self.controller.release()
+                            self._source_end(source)
+                        if self.stopped:
+                            breaker.release()
+                            break
+                        self.controller.on_success(nbytes)
+                        breaker.record_success()
+                        self._source_succeeded(source, host, nbytes, started)
+                        if streaming:
+                            won = self._finish_stream(i, stream)
+                            stream = None
+                        else:
+                            won = self._save_fetched(i, data, ranges, status, validators)
+                        if won:
+                            self._fetch_succeeded(i)
+                        break
+                    except Exception as e:
+                        retry += 1
+                        delay = self._attempt_failed(e, retry, breaker, source)
+                        if delay is None:
+                            self._segment_gave_up(i, e, retry)
                             break
-                        except Exception as e:
-                            retry += 1
-                            time.sleep(0.5 * retry)
+                        self._backoff(delay)
+                self._job_finished(i)
+                if stream:
+                    # Finished streams were handed over; this only drops one abandoned part-way
+                    stream.discard()
 
-            for _ in range(self.num_connections):
-                t = threading.Thread(target=worker)
-                t.start()
-                threads.append(t)
+        # Threads are started lazily so an adaptive limit can grow past num_connections
+        threads = []
+        while True:
+            threads = [t for t in threads if t.is_alive()]
+            if self.jobs_drained or self.stopped:
+                # A request that lost to its hedge may still be waiting on the server; it's daemon, leave it
+                if not threads or self._all_saved():
+                    break
+            else:
+                while len(threads) < self.controller.limit:
+                    t = threading.Thread(target=worker, daemon=True)
+                    t.start()
+                    threads.append(t)
+            threads[0].join(0.2)
 
-            for t in threads:
-                t.join()
+    def _fetch_buffered(self, segment_url, ranges):
+        """ One GET into memory; returns (status, body, validators) """
+        headers = range_header(ranges) if ranges else None
+        start = time.perf_counter()
+        with self.session.get(segment_url, timeout=self.timeout, headers=headers, stream=True) as r:
+            chunks = []
+            for chunk in r.iter_content(CHUNK_SIZE):
+                chunks.append(chunk)
+                self._throttle(len(chunk))
+            data = b"".join(chunks)
+        # r.elapsed stops when the headers are parsed, so it is connect + TTFB
+        ttfb = r.elapsed.total_seconds()
+        self.metrics.observe("ttfb", ttfb)
+        self.metrics.observe("transfer", max(0.0, time.perf_counter() - start - ttfb))
+        if r.status_code not in ((200, 206) if ranges else (200,)):
+            raise HTTPStatusError(r.status_code, r.headers.get("Retry-After"))
+        return r.status_code, data, segment_validators(segment_url, r.headers)
 
-            if self._cancel:
-                self._cleanup()
-                self.done_callback(self.name, False, "Cancelled")
-                return
+    def _attempt_started(self, i, segment_url, ranges):
+        with self._hedge_lock:
+            entry = self._inflight.get(i)
+            if entry:
+                entry[0] = time.monotonic()
+            else:
+                self._inflight[i] = [time.monotonic(), segment_url, ranges, False]
 
-            input_txt = os.path.join(self.segment_dir, "segments.txt")
-            with open(input_txt, "w", encoding="utf-8") as f:
-                for i in range(total):
-                    path = os.path.join(self.segment_dir, f"{i:05d}{segment_ext}").replace("\\", "/")
-                    safe_path = path.replace("'", "'\\''")
-                    f.write(f"file '{safe_path}'\n")
+    def _fetch_succeeded(self, i):
+        # Successful attempt times are what a straggler is measured against; one that lost to its hedge isn't
+        with self._hedge_lock:
+            entry = self._inflight.get(i)
+            if entry:
+                self._fetch_times.append(time.monotonic() - entry[0])
 
-            output_path = os.path.join(self.output_dir, f"{self.name}.mp4")
-            ffmpeg = settings.get("ffmpeg_path", "ffmpeg")
-            if not shutil.which(ffmpeg):
-                self._cleanup()
-                self.done_callback(self.name, False, f"FFmpeg not found: {ffmpeg}")
+    def _job_finished(self, i):
+        with self._hedge_lock:
+            self._inflight.pop(i, None)
+
+    def _all_saved(self):
+        with self._progress_lock:
+            return self.downloaded >= self.total
+
+    def _claim(self, i):
+        """ True for the first of the original and its hedge to finish job i; the other drops its copy """
+        with self._hedge_lock:
+            if i in self._claimed:
+                return False
+            self._claimed.add(i)
+            return True
+
+    def _unclaim(self, i):
+        # The claimed copy turned out unusable; let the other request (or a retry) save it
+        with self._hedge_lock:
+            self._claimed.discard(i)
+
+    def _pick_straggler(self):
+        """
+        The job that has been in flight longest, if that is well past the usual
+        segment time (hedge_factor x p95, at least hedge_min_seconds) and it
+        hasn't been hedged yet. Marks it hedged.
+        """
+        if not self.hedging or self.stopped:
+            return None
+        with self._hedge_lock:
+            if len(self._fetch_times) < 5 or not self._inflight:
+                return None
+            times = sorted(self._fetch_times)
+            p95 = times[int(len(times) * 0.95) - 1]
+            threshold = max(settings.get("hedge_min_seconds", 2.0), settings.get("hedge_factor", 3.0) * p95)
+            now = time.monotonic()
+            candidates = [(entry[0], i) for i, entry in self._inflight.items()
+                          if not entry[3] and now - entry[0] > threshold and i not in self._claimed]
+            if not candidates:
+                return None
+            i = min(candidates)[1]
+            entry = self._inflight[i]
+            entry[3] = True
+            return i, entry[1], entry[2]
+
+    def _route(self, i, segment_url, source=None, stream=None):
+        """
+        (source, url) for the next attempt at job i. A part-streamed segment
+        stays on its source so the Range resume continues the same bytes,
+        unless that source has gone unhealthy; then it starts over elsewhere.
+        """
+        if not self.sources:
+            return None, segment_url
+        if not (stream and stream.received and source and self.sources.healthy(source)):
+            # A retry tries another source first
+            picked = self.sources.pick(avoid=source.host if source else None)
+            if stream and stream.received and picked is not source:
+                stream.discard()
+            source = picked
+        return source, source.urls[i]
+
+    def _hedge_route(self, i, segment_url):
+        """ Where the duplicate request goes: another source's copy of the segment if there is one """
+        if not self.sources:
+            return None, segment_url
+        source = self.sources.pick(avoid=urlparse(segment_url).netloc)
+        return source, source.urls[i]
+
+    def _source_begin(self, source):
+        if source:
+            self.sources.begin(source)
+        return time.monotonic()
+
+    def _source_end(self, source):
+        if source:
+            self.sources.end(source)
+
+    def _source_succeeded(self, source, host, nbytes, started):
+        if source:
+            self.sources.record(source, nbytes, time.monotonic() - started)
+            self.metrics.source_used(host)
+
+    def _hedge(self, i, segment_url, ranges):
+        """ One duplicate attempt for a straggling job; a failure just leaves the original to finish """
+        source, url = self._hedge_route(i, segment_url)
+        host = urlparse(url).netloc
+        if not self.controller.try_acquire():
+            return
+        if not self.scheduler.acquire(self, host, lambda: self.stopped):
+            self.controller.release()
+            return
+        self.metrics.hedged()
+        started = self._source_begin(source)
+        try:
+            try:
+                status, data, validators = self._fetch_buffered(url, ranges)
+            finally:
+                self.scheduler.release(self, host)
+                self.controller.release()
+                self._source_end(source)
+            self._source_succeeded(source, host, len(data), started)
+            if not self.stopped and self._save_fetched(i, data, ranges, status, validators):
+                self.metrics.hedge_won()
+        except Exception as e:
+            self.metrics.attempt_failed(e)
+            if source:
+                self.sources.record_failure(source)
+
+    def _attempt_failed(self, e, attempt, breaker, source=None):
+        """ Book-keeping for a failed attempt; returns the backoff before the next one, or None to give up """
+        self.controller.on_error(getattr(e, "status", None))
+        self.metrics.attempt_failed(e)
+        if source:
+            self.sources.record_failure(source)
+        if self.retry_policy.classify(e) == FATAL:
+            # The origin answered; it just won't serve this segment. Another source still might.
+            breaker.record_success()
+            if source and attempt < len(self.sources.sources):
+                return 0
+            return None
+        breaker.record_failure()
+        if attempt > self.max_retries:
+            return None
+        return self.retry_policy.delay(attempt, e)
+
+    def _backoff(self, delay, interrupted=None):
+        # Sleep in short steps so cancel/stop isn't held up by a long Retry-After
+        deadline = time.monotonic() + delay
+        while not self.stopped and time.monotonic() < deadline and not (interrupted and interrupted()):
+            time.sleep(min(0.2, max(0.0, deadline - time.monotonic())))
+
+    def _bandwidth_limits(self):
+        return self.bandwidth.version, self.job_bandwidth.version
+
+    def _bandwidth_delay(self, nbytes):
+        """ Charge nbytes to both buckets; returns (wait, check ending the wait early if a limit changes) """
+        limits = self._bandwidth_limits()
+        delay = max(self.bandwidth.take(nbytes), self.job_bandwidth.take(nbytes))
+        return delay, lambda: self._bandwidth_limits() != limits
+
+    def _throttle(self, nbytes):
+        delay, changed = self._bandwidth_delay(nbytes)
+        if delay:
+            self._backoff(delay, changed)
+
+    def _segment_gave_up(self, i, error, attempts):
+        self.metrics.segment_gave_up()
+        if self.live:
+            # The live window moves on without it; keep recording around the gap
+            self._skip_segment(i)
+            return
+        # Without this segment the output can't be complete, so fail now rather than after the rest
+        self._fail(f"Segment {i} failed after {attempts} attempt(s): {error_cause(error)}")
+
+    def _key_ready(self, i):
+        """ True if opening segment i's stream won't have to fetch its key """
+        key_info = self.segment_keys.get(i)
+        return not key_info or self.keys.has(key_info[0])
+
+    def _open_stream(self, i):
+        key_info = self.segment_keys.get(i)
+        if key_info:
+            key_url, iv = key_info
+            return StreamingSegment(self.store, self.keys.get(key_url), iv)
+        return StreamingSegment(self.store)
+
+    def _fetch_streaming(self, segment_url, stream, i=None):
+        """ Stream one segment to disk, continuing from stream.received if an earlier attempt broke off """
+        start = time.perf_counter()
+        with self.session.get(segment_url, timeout=self.timeout, headers=stream.resume_headers(), stream=True) as r:
+            ttfb = time.perf_counter() - start
+            self.metrics.observe("ttfb", ttfb)
+            if r.status_code not in (200, 206):
+                raise HTTPStatusError(r.status_code, r.headers.get("Retry-After"))
+            length = r.headers.get("Content-Length", "")
+            stream.begin(r.status_code, int(length) if length.isdigit() else None)
+            stream.validators = segment_validators(segment_url, r.headers)
+            local = stream.decrypt_seconds + stream.write_seconds
+            for chunk in r.iter_content(CHUNK_SIZE):
+                # A hedge that already saved this segment cancels the rest of the read
+                if self.stopped or i in self._claimed:
+                    break
+                stream.write(chunk)
+                self._throttle(len(chunk))
+            # Network time only: decrypt and write happen inline and are reported on their own
+            local = stream.decrypt_seconds + stream.write_seconds - local
+            self.metrics.observe("transfer", max(0.0, time.perf_counter() - start - ttfb - local))
+        return stream.received
+
+    def _to_cpu_pool(self, fn, *args):
+        """ Run fn on the shared CPU pool; while the pool is full this holds the fetcher back """
+        if getattr(self._slot_taken, "held", False):
+            self._slot_taken.held = False
+        elif not self.cpu_pool.acquire(lambda: self.stopped):
+            return
+        future = self.cpu_pool.submit(self._run_staged, fn, *args)
+        with self._staged_lock:
+            self._staged.add(future)
+        future.add_done_callback(self._staged_done)
+
+    def _run_staged(self, fn, *args):
+        if self.stopped:
+            return
+        try:
+            fn(*args)
+        except Exception as e:
+            # The body was already claimed, so a fetch retry can't help: fail the job
+            self._fail(f"Error: {e}")
+
+    def _staged_done(self, future):
+        with self._staged_lock:
+            self._staged.discard(future)
+
+    def _drain_cpu_pool(self):
+        with self._staged_lock:
+            pending = list(self._staged)
+        wait(pending)
+
+    def _finish_stream(self, i, stream):
+        """
+        Hand a fully received stream on to be decrypted and indexed.
+        The stream is taken over unless this raises (a short body, to retry).
+        Returns False if a racing hedged request saved it first.
+        """
+        if not self._claim(i):
+            stream.discard()
+            return False
+        if stream.received < MIN_SEGMENT_BYTES:
+            received = stream.received
+            stream.discard()
+            self._unclaim(i)
+            raise Exception(f"Incomplete segment ({received} bytes)")
+        if stream.key or self.cache:
+            self._to_cpu_pool(self._store_stream, i, stream)
+        else:
+            # Already in place, only the index entry is left
+            self._store_stream(i, stream)
+        return True
+
+    def _store_stream(self, i, stream):
+        # The cache keeps the body as served, so read it back before it is decrypted in place
+        served = stream.served() if self.cache else None
+        try:
+            offset, size = stream.finish()
+        except DecryptionError as e:
+            stream.discard()
+            self._fail(f"Decryption failed: {e}")
+            return
+        if stream.key:
+            self.metrics.observe("decrypt", stream.decrypt_seconds)
+        self.metrics.observe("write", stream.write_seconds)
+        self._segment_done(i, size, offset, stream.crc)
+        if served is not None:
+            self.cache.put(*self._cache_keys[i], served, stream.validators)
+
+    def _save_fetched(self, i, data, ranges=None, status=200, validators=None):
+        """
+        Check one fetched body, which for a coalesced Range request holds several
+        segments, and queue it to be decrypted and written. Returns False if a
+        racing hedged request saved it first.
+        """
+        pieces = split_ranges(data, ranges, status) if ranges else [(i, data)]
+        for index, piece in pieces:
+            if len(piece) < MIN_SEGMENT_BYTES:
+                raise Exception(f"Incomplete segment ({len(piece)} bytes)")
+        if not self._claim(i):
+            return False
+        self._to_cpu_pool(self._store_pieces, pieces, validators, self.cache is not None)
+        return True
+
+    def _store_pieces(self, pieces, validators=None, cache=False):
+        for index, piece in pieces:
+            self._save_segment(index, piece)
+            if cache and not self.stopped:
+                self.cache.put(*self._cache_keys[index], piece, validators)
+
+    def _from_cache(self, i, ranges):
+        """ Save job i straight from the segment cache if every segment of it is there; True if it was """
+        if not self.cache:
+            return False
+        pieces = []
+        fresh = {}
+        for index in [r[0] for r in ranges] if ranges else [i]:
+            hit = self.cache.get(*self._cache_keys[index])
+            if not hit:
+                return False
+            data, validators = hit
+            if self.cache_revalidate:
+                url = validators["url"] if validators else None
+                if url not in fresh:
+                    fresh[url] = self._still_fresh(validators)
+                if not fresh[url]:
+                    return False
+            pieces.append((index, data))
+        for index, data in pieces:
+            self.metrics.cache_hit(len(data))
+        if self._claim(i):
+            self._to_cpu_pool(self._store_pieces, pieces)
+        return True
+
+    def _still_fresh(self, validators):
+        """ Conditional GET for a cached body: True if the origin answers 304 Not Modified """
+        if not validators:
+            # Nothing to revalidate with, so it can't be trusted
+            return False
+        try:
+            with self.session.get(validators["url"], headers=conditional_headers(validators),
+                                  timeout=self.timeout, stream=True) as r:
+                return r.status_code == 304
+        except Exception:
+            return False
+
+    def _save_segment(self, i, data):
+        """ Decrypt and write one downloaded segment, then report progress """
+        key_info = self.segment_keys.get(i)
+        if key_info:
+            start = time.perf_counter()
+            try:
+                data = self.keys.decrypt(data, *key_info)
+            except Exception as e:
+                self._fail(f"Decryption failed: {e}")
                 return
+            self.metrics.observe("decrypt", time.perf_counter() - start)
+
+        offset = crc = None
+        if self.muxer:
+            self.muxer.feed(i, data)
+        else:
+            start = time.perf_counter()
+            offset, _ = self.store.put(data)
+            crc = zlib.crc32(data)
+            self.metrics.observe("write", time.perf_counter() - start)
+        self._segment_done(i, len(data), offset, crc)
 
-            cmd = [ffmpeg, "-y", "-f", "concat", "-safe", "0", "-i", input_txt, "-c", "copy", output_path]
+    def _segment_done(self, i, size, offset=None, crc=None):
+        if self.store:
+            self.store.commit(i, offset, size)
+            self.journal.mark_done(i, offset, size, crc)
+        self.metrics.segment_done(size)
+        with self._progress_lock:
+            self.downloaded += 1
+            self.downloaded_bytes += size
+            self.downloaded_seconds += self.durations.get(i, 0)
+        self._report_progress()
 
-            startupinfo = None
-            if sys.platform == "win32":
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    def _report_progress(self):
+        with self._progress_lock:
+            downloaded, downloaded_bytes = self.downloaded, self.downloaded_bytes
+            byte_rate = self._byte_rate.update(downloaded_bytes)
+            media_rate = self._media_rate.update(self.downloaded_seconds)
+            remaining_seconds = self.total_seconds - self.downloaded_seconds
 
-            result = subprocess.run(cmd, capture_output=True, startupinfo=startupinfo)
-            if result.returncode != 0:
+        if byte_rate:
+            speed = byte_rate / 1024 / 1024
+        else:
+            # No smoothed sample yet: fall back to the average since the start
+            elapsed = time.time() - self.start_time + 0.1
+            speed = downloaded_bytes / 1024 / 1024 / elapsed
+        percent = (downloaded / self.total) * 100
+        estimated_size = ((downloaded_bytes / downloaded) * self.total / 1024 / 1024) if downloaded else 0
+        # ETA from the EXTINF durations still to fetch; a live stream has no end to estimate
+        eta = remaining_seconds / media_rate if media_rate and not self.live else None
+
+        self.progress_callback(self.name, percent, downloaded_bytes / 1024 / 1024, estimated_size, speed, self.controller.limit, eta)
+
+    def _mux(self):
+        if self.muxer:
+            self.muxer.set_total(self.total)
+            start = time.perf_counter()
+            returncode, err = self.muxer.finish()
+            # Only the tail: most of the streamed mux overlapped with the download
+            self.metrics.observe("mux", time.perf_counter() - start)
+            if returncode != 0:
                 self._cleanup()
-                err = result.stderr.decode().strip()
-                self.done_callback(self.name, False, f"FFmpeg error:\n{err}")
+                self.done_callback(self.name, False, f"{'Output' if self.native else 'FFmpeg'} error:\n{err}")
                 return
+            self.done_callback(self.name, True, f"Download complete: {self.output_path}")
+            return
+
+        if self.native:
+            self._join_native()
+            return
+
+        input_txt = os.path.join(self.segment_dir, "segments.txt")
+        store_path = self.store.path.replace("\\", "/")
+        with open(input_txt, "w", encoding="utf-8") as f:
+            for i in range(self.total):
+                if i in self.skipped:
+                    continue
+                # ffmpeg's subfile protocol reads each segment's region of the store in place
+                offset, length = self.store.index[i]
+                path = f"subfile,,start,{offset},end,{offset + length},,:{store_path}"
+                safe_path = path.replace("'", "'\\''")
+                f.write(f"file '{safe_path}'\n")
 
+        output_path = self.output_path
+        ffmpeg = self.ffmpeg
+        if not shutil.which(ffmpeg):
             self._cleanup()
-            self.done_callback(self.name, True, f"Download complete: {output_path}")
+            self.done_callback(self.name, False, f"FFmpeg not found: {ffmpeg}")
+            return
 
-        except Exception as e:
+        cmd = [ffmpeg, "-y", "-f", "concat", "-safe", "0", "-protocol_whitelist", "file,subfile",
+               "-i", input_txt, "-c", "copy", output_path]
+
+        start = time.perf_counter()
+        result = subprocess.run(cmd, capture_output=True, startupinfo=ffmpeg_startupinfo())
+        self.metrics.observe("mux", time.perf_counter() - start)
+        if result.returncode != 0:
             self._cleanup()
-            self.done_callback(self.name, False, f"Error: {str(e)}")
+            err = result.stderr.decode().strip()
+            self.done_callback(self.name, False, f"FFmpeg error:\n{err}")
+            return
+
+        self._cleanup()
+        self.done_callback(self.name, True, f"Download complete: {output_path}")
+
+    def _join_native(self):
+        """ Concatenate the stored segments in order, each init segment ahead of the first segment that uses it """
+        parts = []
+        init = None
+        for i in range(self.total):
+            if i in self.skipped:
+                continue
+            if self.segment_inits.get(i, init) is not init:
+                init = self.segment_inits[i]
+                parts.append(init)
+            parts.append((self.store.path, *self.store.index[i]))
+
+        start = time.perf_counter()
+        try:
+            concat_segments(self.output_path, parts, settings.get("zero_copy_join", True))
+        except OSError as e:
+            self._cleanup()
+            self.done_callback(self.name, False, f"Output error:\n{e}")
+            return
+        self.metrics.observe("mux", time.perf_counter() - start)
+        self._cleanup()
+        self.done_callback(self.name, True, f"Download complete: {self.output_path}")
 
     def _cleanup(self):
+        if self.journal:
+            self.journal.close()
+        if self.store:
+            self.store.close()
+        # A still-running muxer means the job failed mid-stream: stop it and drop the partial file
+        if self.muxer and self.muxer.running():
+            self.muxer.abort()
         if self.segment_dir and os.path.exists(self.segment_dir):
             shutil.rmtree(self.segment_dir, ignore_errors=True)
@@ -6,16 +6,22 @@ import shutil
 import glob
 import subprocess
 import platform
+import time
 import customtkinter as ctk
 from tkinter import messagebox
 
-from downloader import DownloadWorker
-from settings import load_settings
+from downloader import DownloadWorker, OUTPUT_EXTENSIONS
+from journal import find_jobs, has_journal
+from settings import load_settings, store as settings_store
 from settings_ui import build_settings_tab
 from notifier import notify
+from progress import ProgressAggregator, REFRESH_INTERVAL
 
 import tkinter as tk
 
+# Seconds the window waits on close for jobs to save their journals (or clear out what can't resume)
+CLOSE_TIMEOUT = 5
+
 class Tooltip:
     def __init__(self, widget, text):
         self.widget = widget
@@ -83,6 +89,8 @@ class DownloaderApp:
         self.queue = []
         self.resume_queue = []
         self.active_downloads = 0
+        # Workers publish here; the GUI redraws every job at most REFRESH_INTERVAL apart
+        self.progress = ProgressAggregator()
 
         root.title("M3U8 Video Downloader")
         root.geometry("800x500")
@@ -98,14 +106,66 @@ class DownloaderApp:
         self.build_download_tab()
         self.build_log_tab()
         build_settings_tab(self.notebook, self.reload_settings)
+        self.restore_jobs()
+        self.flush_progress()
 
         root.protocol("WM_DELETE_WINDOW", self.on_close)
 
+    def flush_progress(self):
+        """ Apply the latest progress of every job in one pass, then reschedule """
+        for name, update in self.progress.drain().items():
+            self.update_progress(name, *update)
+        # Pick up hand edits of the settings file; a stat at most once a second
+        settings_store.poll()
+        self.root.after(int(REFRESH_INTERVAL * 1000), self.flush_progress)
+
+    def update_progress(self, name, percent, downloaded_mb, estimated_mb, speed, connections=None, eta=None):
+        w = self.download_widgets.get(name)
+        if not w:
+            return
+        w["progress"].set(percent / 100)
+
+        # Live streams get a button to end the recording and keep it
+        worker = self.workers.get(name)
+        if worker and worker.live and "stop_btn" not in w:
+            stop_btn = ctk.CTkButton(w["pause_btn"].master, text="Stop & Save", width=80,
+                                     command=lambda: self.stop_recording(name))
+            stop_btn.grid(row=0, column=2, padx=5)
+            w["stop_btn"] = stop_btn
+
+        # === ETA: from the worker's EXTINF estimate, else from the remaining size
+        if eta is None:
+            remaining_mb = max(0, estimated_mb - downloaded_mb)
+            eta = remaining_mb / speed if speed > 0 else 0
+        mins, secs = divmod(int(eta), 60)
+        eta_text = f"{mins}m {secs}s" if mins > 0 else f"{secs}s"
+
+        # === Updated status text
+        w["status"].configure(
+            text=(
+                f"⬇️ {percent:.2f}% - {downloaded_mb:.2f}MB / ~{estimated_mb:.2f}MB "
+                f"@ {speed:.2f}MB/s | ETA: {eta_text}"
+                + (f" | {connections} conn" if connections else "")
+            ),
+            text_color="lightblue"
+        )
+
     def clean_old_segments(self):
         segments_root = os.path.join(self.settings["output_dir"], "segments")
         if os.path.exists(segments_root):
             for folder in glob.glob(os.path.join(segments_root, "*")):
-                shutil.rmtree(folder, ignore_errors=True)
+                # Journaled folders hold a resumable job, keep them
+                if not has_journal(folder):
+                    shutil.rmtree(folder, ignore_errors=True)
+
+    def restore_jobs(self):
+        """ Re-queue unfinished jobs whose segment journal survived an app close or crash """
+        for manifest in find_jobs(self.settings.get("output_dir", "")):
+            name = manifest["name"]
+            if name in self.workers:
+                continue
+            self.log_box.insert("end", f"[{name}] Resuming unfinished download.\n")
+            self.queue_download(name, manifest["url"], manifest["output_dir"])
 
     def reload_settings(self):
         self.settings = load_settings()
@@ -153,11 +213,15 @@ class DownloaderApp:
     def on_close(self):
         for worker in self.workers.values():
             try:
-                worker.cancel()
-                if worker.segment_dir and os.path.exists(worker.segment_dir):
-                    shutil.rmtree(worker.segment_dir, ignore_errors=True)
+                # Keep finished segments on disk; the journal lets the job resume next launch
+                worker.cancel(keep_segments=True)
             except Exception as e:
                 print(f"[Cleanup Error] {e}")
+        # Worker threads are daemons: give them a moment to finish cancelling before the process exits
+        deadline = time.monotonic() + CLOSE_TIMEOUT
+        for worker in self.workers.values():
+            if worker.is_alive():
+                worker.join(max(0.0, deadline - time.monotonic()))
         self.root.destroy()
 
     # [Your download logic, callbacks, pause/cancel remain unchanged]
@@ -239,7 +303,7 @@ class DownloaderApp:
    
         name = raw_name
         counter = 1
-        while os.path.exists(os.path.join(output_path, name + ".mp4")):
+        while any(os.path.exists(os.path.join(output_path, name + ext)) for ext in OUTPUT_EXTENSIONS):
             name = f"{raw_name}_{counter}"
             counter += 1
     
@@ -247,36 +311,20 @@ class DownloaderApp:
             messagebox.showwarning("Already Exists", f"Download '{name}' is already queued or running.")
             return
     
+        self.queue_download(name, url, output_path)
+
+    def queue_download(self, name, url, output_path):
         pause_btn, cancel_btn = self.add_download_widget(name)
     
-        def progress_callback(name, percent, downloaded_mb, estimated_mb, speed):
-            def safe_update():
-                w = self.download_widgets.get(name)
-                if w:
-                    w["progress"].set(percent / 100)
-        
-                    # === ETA calculation ===
-                    remaining_mb = max(0, estimated_mb - downloaded_mb)
-                    eta_seconds = remaining_mb / speed if speed > 0 else 0
-                    mins, secs = divmod(int(eta_seconds), 60)
-                    eta_text = f"{mins}m {secs}s" if mins > 0 else f"{secs}s"
-        
-                    # === Updated status text
-                    w["status"].configure(
-                        text=(
-                            f"⬇️ {percent:.2f}% - {downloaded_mb:.2f}MB / ~{estimated_mb:.2f}MB "
-                            f"@ {speed:.2f}MB/s | ETA: {eta_text}"
-                        ),
-                        text_color="lightblue"
-                    )
-            self.root.after(0, safe_update)
-           
         def done_callback(name, success, msg):
             def safe_gui_update():
                 w = self.download_widgets.get(name)
                 if not w:
                     return
         
+                # Drop a progress update still waiting for the next tick so it can't overwrite the result
+                self.progress.discard(name)
+
                 icon = "✅" if success else "❌"
                 color = "lightgreen" if success else "red"
         
@@ -284,7 +332,9 @@ class DownloaderApp:
                     w["status"].configure(text="✅ Download complete", text_color=color)
         
                     # Generate clickable, truncated path
-                    output_path = os.path.join(self.settings["output_dir"], f"{name}.mp4")
+                    # The extension depends on the stream (.ts/.aac kept natively, fMP4 as .mp4)
+                    worker = self.workers.get(name)
+                    output_path = getattr(worker, "output_path", None) or os.path.join(self.settings["output_dir"], f"{name}.mp4")
                     short_display_path = shorten_path_middle(output_path, 80)
                     display_path = "📂 " + short_display_path
         
@@ -308,6 +358,8 @@ class DownloaderApp:
         
                 # Disable pause button
                 w["pause_btn"].configure(state="disabled")
+                if "stop_btn" in w:
+                    w["stop_btn"].destroy()
                 
                 # Remove cancel button and add Remove button instead
                 w["cancel_btn"].destroy()  # Remove Cancel button
@@ -334,6 +386,11 @@ class DownloaderApp:
                 note_msg = clipped_msg[:250] + "..." if len(clipped_msg) > 250 else clipped_msg
         
                 self.log_box.insert("end", f"[{name}] {log_msg}\n")
+                # Per-job timings and retry causes, to see where a slow download spent its time
+                worker = self.workers.get(name)
+                if worker:
+                    for line in worker.metrics.summary():
+                        self.log_box.insert("end", f"[{name}]   {line}\n")
                 self.log_box.see("end")
         
                 self.active_downloads = max(0, self.active_downloads - 1)
@@ -348,7 +405,7 @@ class DownloaderApp:
             name=name,
             url=url,
             output_dir=output_path,
-            progress_callback=progress_callback,
+            progress_callback=self.progress.publish,
             done_callback=done_callback,
             num_connections=self.settings["num_connections"]
         )
@@ -416,6 +473,13 @@ class DownloaderApp:
             if name in self.resume_queue:
                 self.resume_queue.remove(name)
 
+    def stop_recording(self, name):
+        if name in self.workers:
+            self.workers[name].stop()
+            w = self.download_widgets[name]
+            w["status"].configure(text="⏹️ Finishing recording...", text_color="orange")
+            w["stop_btn"].configure(state="disabled")
+
     def cancel_all(self):
         for name in list(self.workers.keys()):
             self.cancel_download(name)
@@ -0,0 +1,111 @@
+import threading
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+import playlist as m3u8_parser
+
+# Number of distinct hosts whose connection pools are kept alive at once
+MAX_HOSTS = 32
+# Playlists kept with their validators, so loading one again is a conditional request
+PLAYLIST_CACHE_SIZE = 16
+
+_lock = threading.Lock()
+_session = None
+_pool_size = 0
+_playlists = OrderedDict()
+_playlists_lock = threading.Lock()
+
+
+def get_session(pool_size=8):
+    """
+    Return the process-wide keep-alive session shared by all downloads.
+    The per-host pool only ever grows, so a later, bigger job never
+    shrinks the pool a running job is using.
+    """
+    global _session, _pool_size
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+        if pool_size > _pool_size:
+            adapter = HTTPAdapter(pool_connections=MAX_HOSTS, pool_maxsize=pool_size)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _pool_size = pool_size
+        return _session
+
+
+def fetch(url, timeout=10, **kwargs):
+    return get_session().get(url, timeout=timeout, **kwargs)
+
+
+def _playlist_text(r):
+    # Playlists are UTF-8 by spec, so skip requests' charset guessing
+    return r.content.decode("utf-8-sig", errors="replace")
+
+
+def fetch_playlist(url, timeout=10):
+    """
+    (final URL, text) of a playlist. A copy from an earlier load is
+    revalidated with its ETag / Last-Modified instead of fetched again.
+    """
+    with _playlists_lock:
+        cached = _playlists.get(url)
+    r = fetch(url, timeout=timeout, headers=conditional_headers(cached[0] if cached else None))
+    if r.status_code == 304 and cached:
+        with _playlists_lock:
+            if url in _playlists:
+                _playlists.move_to_end(url)
+        return cached[1], cached[2]
+    if r.status_code != 200:
+        raise Exception(f"HTTP {r.status_code} loading playlist {url}")
+    # r.url follows redirects, so relative segment URIs resolve like m3u8.load did
+    text = _playlist_text(r)
+    validators = response_validators(r.headers)
+    if any(validators.values()):
+        with _playlists_lock:
+            _playlists[url] = (validators, r.url, text)
+            _playlists.move_to_end(url)
+            while len(_playlists) > PLAYLIST_CACHE_SIZE:
+                _playlists.popitem(last=False)
+    return r.url, text
+
+
+def load_playlist(url, timeout=10, lazy=False):
+    """
+    Fetch and parse a playlist through the shared session (replaces m3u8.load).
+    With lazy, a media playlist's segments are left to its parse().
+    """
+    final_url, text = fetch_playlist(url, timeout)
+    return m3u8_parser.loads(text, final_url, lazy)
+
+
+def response_validators(headers):
+    """ ETag / Last-Modified of a response, to make a later request for the same URL conditional """
+    return {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified")
+    }
+
+
+def conditional_headers(validators):
+    headers = {}
+    validators = validators or {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def refresh_playlist(url, timeout=10, validators=None):
+    """
+    Conditional re-fetch of a live playlist. validators holds the ETag /
+    Last-Modified of the previous response; returns (playlist, validators),
+    with playlist None when the server answered 304 Not Modified.
+    """
+    r = fetch(url, timeout=timeout, headers=conditional_headers(validators))
+    if r.status_code == 304:
+        return None, validators or {}
+    if r.status_code != 200:
+        raise Exception(f"HTTP {r.status_code} loading playlist {url}")
+    return m3u8_parser.loads(_playlist_text(r), r.url), response_validators(r.headers)
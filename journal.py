@@ -0,0 +1,110 @@
+import glob
+import json
+import os
+import threading
+import zlib
+
+MANIFEST_FILE = "manifest.json"
+LOG_FILE = "segments.log"
+# 2: segments live in one SegmentStore file and the log holds their (offset, length)
+# 3: plus a CRC32 of each segment, since the preallocated file is always long enough
+JOURNAL_VERSION = 3
+
+
+class SegmentJournal:
+    """
+    Crash-safe record of a job kept inside its segment folder.
+    manifest.json holds what is needed to restart the job (playlist, variant, key),
+    segments.log is the index of the job's SegmentStore: one "index offset length crc32"
+    line per segment once it is fully written.
+    """
+
+    def __init__(self, segment_dir):
+        self.segment_dir = segment_dir
+        self.manifest_path = os.path.join(segment_dir, MANIFEST_FILE)
+        self.log_path = os.path.join(segment_dir, LOG_FILE)
+        self._lock = threading.Lock()
+        self._log = None
+        # True once start() wrote a manifest, i.e. the folder is something a later run can resume
+        self.started = False
+
+    def load(self):
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("version") != JOURNAL_VERSION:
+                return None
+            return manifest
+        except (OSError, ValueError):
+            return None
+
+    def start(self, manifest):
+        """ Write the manifest atomically; a new job also starts with an empty log """
+        manifest = dict(manifest, version=JOURNAL_VERSION)
+        log_mode = "a"
+        if self.load() != manifest:
+            # Different playlist/variant/key: earlier log entries no longer describe these files
+            log_mode = "w"
+            tmp = self.manifest_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.manifest_path)
+        self._log = open(self.log_path, log_mode, encoding="utf-8")
+        self.started = True
+        if log_mode == "a" and self._log.tell() > 0:
+            # Terminate a line torn by a crash so the next entry starts clean
+            self._log.write("\n")
+
+    def completed(self, data_path):
+        """
+        Return {index: (offset, length)} for logged segments whose bytes are
+        still what was logged. The log can reach the disk before the data
+        (a power loss), and those regions read back as zeros, so each one is
+        checked against its CRC32.
+        """
+        done = {}
+        try:
+            with open(self.log_path, "r", encoding="utf-8") as log, open(data_path, "rb") as data:
+                for line in log:
+                    parts = line.split()
+                    # A torn last line from a crash is simply ignored
+                    if len(parts) != 4 or not all(p.isdigit() for p in parts):
+                        continue
+                    i, offset, length, crc = map(int, parts)
+                    data.seek(offset)
+                    chunk = data.read(length)
+                    if len(chunk) == length and zlib.crc32(chunk) == crc:
+                        done[i] = (offset, length)
+        except OSError:
+            return {}
+        return done
+
+    def mark_done(self, i, offset, length, crc):
+        with self._lock:
+            if self._log:
+                self._log.write(f"{i} {offset} {length} {crc}\n")
+                self._log.flush()
+
+    def close(self):
+        with self._lock:
+            if self._log:
+                self._log.close()
+                self._log = None
+
+
+def find_jobs(output_dir):
+    """ Manifests of unfinished jobs left in output_dir by a previous run """
+    jobs = []
+    if not output_dir or not os.path.isdir(output_dir):
+        return jobs
+    for path in sorted(glob.glob(os.path.join(output_dir, "*_segments", MANIFEST_FILE))):
+        manifest = SegmentJournal(os.path.dirname(path)).load()
+        if manifest and manifest.get("name") and manifest.get("url"):
+            jobs.append(manifest)
+    return jobs
+
+
+def has_journal(segment_dir):
+    return os.path.exists(os.path.join(segment_dir, MANIFEST_FILE))
@@ -0,0 +1,105 @@
+import threading
+from urllib.parse import urljoin
+
+
+class DecryptionError(Exception):
+    pass
+
+
+def parse_iv(value):
+    value = value[2:] if value.lower().startswith("0x") else value
+    return bytes.fromhex(value.zfill(32))
+
+
+def segment_key(seg, sequence, base_url):
+    """
+    (key_url, iv) for the EXT-X-KEY in effect for seg, or None if it is clear.
+    Without an explicit IV the spec uses the segment's media sequence number.
+    """
+    key = seg.key
+    if not key or not key.method or key.method.upper() == "NONE":
+        return None
+    if key.method.upper() != "AES-128":
+        raise Exception(f"Unsupported encryption method: {key.method}")
+    key_url = key.absolute_uri or urljoin(base_url, key.uri)
+    iv = parse_iv(key.iv) if key.iv else sequence.to_bytes(16, byteorder="big")
+    return key_url, iv
+
+
+def decrypt(key, iv, data):
+    decryptor = StreamDecryptor(key, iv)
+    return decryptor.update(data) + decryptor.finalize()
+
+
+class KeyManager:
+    """
+    Fetches each key URI once and caches it for the rest of the job, so
+    key-rotating streams cost one request per key rather than per segment.
+    """
+
+    def __init__(self, session, timeout=10, cache=None):
+        self.session = session
+        self.timeout = timeout
+        self._keys = {uri: bytes.fromhex(key) for uri, key in (cache or {}).items()}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, uri):
+        key = self._keys.get(uri)
+        if key is not None:
+            return key
+        with self._lock:
+            lock = self._locks.setdefault(uri, threading.Lock())
+        # Connections that need the same new key wait for one fetch instead of racing
+        with lock:
+            if uri not in self._keys:
+                r = self.session.get(uri, timeout=self.timeout)
+                if r.status_code != 200:
+                    raise Exception(f"HTTP {r.status_code} fetching key {uri}")
+                if len(r.content) != 16:
+                    raise Exception(f"Invalid AES-128 key ({len(r.content)} bytes) from {uri}")
+                self._keys[uri] = r.content
+        return self._keys[uri]
+
+    def has(self, uri):
+        return uri in self._keys
+
+    def decrypt(self, data, key_url, iv):
+        return decrypt(self.get(key_url), iv, data)
+
+    def export(self):
+        return {uri: key.hex() for uri, key in self._keys.items()}
+
+
+class StreamDecryptor:
+    """
+    Incremental AES-128-CBC decryption for a segment that arrives in chunks.
+    The last decrypted block is held back until finalize() so its PKCS#7
+    padding can be removed.
+    """
+
+    def __init__(self, key, iv):
+        from Crypto.Cipher import AES
+
+        self._cipher = AES.new(key, AES.MODE_CBC, iv)
+        self._carry = b""
+        self._held = b""
+
+    def update(self, chunk):
+        buf = self._carry + chunk
+        usable = len(buf) - len(buf) % 16
+        self._carry = buf[usable:]
+        if not usable:
+            return b""
+        out = self._held + self._cipher.decrypt(buf[:usable])
+        self._held = out[-16:]
+        return out[:-16]
+
+    def finalize(self):
+        if self._carry:
+            raise DecryptionError(f"Encrypted data is not a multiple of 16 bytes ({len(self._carry)} left over)")
+        data = self._held
+        pad = data[-1] if data else 0
+        if 1 <= pad <= 16 and data[-pad:] == bytes([pad]) * pad:
+            data = data[:-pad]
+        return data
@@ -0,0 +1,291 @@
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from settings import store as settings
+
+# Phases timed for every segment; "mux" is timed once per job
+PHASES = ["ttfb", "transfer", "decrypt", "write", "mux"]
+
+# Histogram bucket upper bounds in seconds (Prometheus style, +Inf is implied)
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+def error_cause(e):
+    """ Short, stable label for why an attempt failed: "HTTP 503", "ReadTimeout", ... """
+    status = getattr(e, "status", None)
+    return f"HTTP {status}" if status else type(e).__name__
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def merge(self, other):
+        for n, c in enumerate(other.counts):
+            self.counts[n] += c
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-quantile """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for n, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return BUCKETS[n] if n < len(BUCKETS) else float("inf")
+        return float("inf")
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "buckets": dict(zip([*map(str, BUCKETS), "+Inf"], self.counts))}
+
+
+class JobMetrics:
+    """
+    Phase timings, retries and error causes of one download. Written from every
+    connection of the job, so updates take a lock; each is a few additions.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.phases = {phase: Histogram() for phase in PHASES}
+        self.errors = Counter()
+        self.segments = 0
+        self.bytes = 0
+        self.retries = 0
+        self.gave_up = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.cache_hits = 0
+        self.cache_bytes = 0
+        # Segments per host when a job is spread over several sources
+        self.hosts = Counter()
+        self.result = None
+        self.started = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            self.phases[phase].observe(seconds)
+
+    def segment_done(self, size):
+        with self._lock:
+            self.segments += 1
+            self.bytes += size
+
+    def attempt_failed(self, e):
+        with self._lock:
+            self.retries += 1
+            self.errors[error_cause(e)] += 1
+
+    def segment_gave_up(self):
+        with self._lock:
+            self.gave_up += 1
+
+    def hedged(self):
+        with self._lock:
+            self.hedges += 1
+
+    def hedge_won(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def cache_hit(self, size):
+        with self._lock:
+            self.cache_hits += 1
+            self.cache_bytes += size
+
+    def source_used(self, host):
+        with self._lock:
+            self.hosts[host] += 1
+
+    def finish(self, result):
+        self.result = result
+        self.finished = time.time()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "result": self.result,
+                "started": self.started,
+                "finished": self.finished,
+                "segments": self.segments,
+                "bytes": self.bytes,
+                "retries": self.retries,
+                "gave_up": self.gave_up,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "cache_hits": self.cache_hits,
+                "cache_bytes": self.cache_bytes,
+                "hosts": dict(self.hosts),
+                "errors": dict(self.errors),
+                "phases": {phase: h.to_dict() for phase, h in self.phases.items()}
+            }
+
+    def summary(self):
+        """ A few lines for the Logs tab """
+        with self._lock:
+            elapsed = (self.finished or time.time()) - self.started
+            lines = [f"{self.segments} segments, {self.bytes / 1024 / 1024:.2f} MB in {elapsed:.1f}s, "
+                     f"{self.retries} retries, {self.gave_up} given up"]
+            if self.hedges:
+                lines.append(f"hedged {self.hedges} straggler(s), {self.hedge_wins} won")
+            if self.cache_hits:
+                lines.append(f"{self.cache_hits} segment(s), {self.cache_bytes / 1024 / 1024:.2f} MB served from the cache")
+            if len(self.hosts) > 1:
+                lines.append("sources: " + ", ".join(f"{host} x{n}" for host, n in self.hosts.most_common()))
+            if self.errors:
+                lines.append("errors: " + ", ".join(f"{cause} x{n}" for cause, n in self.errors.most_common()))
+            timings = []
+            for phase, h in self.phases.items():
+                if h.count:
+                    if phase == "mux":
+                        timings.append(f"mux {h.sum:.1f}s")
+                        continue
+                    p95 = h.quantile(0.95)
+                    p95_text = f"<={p95 * 1000:.0f}ms" if p95 != float("inf") else f">{BUCKETS[-1]}s"
+                    timings.append(f"{phase} avg {h.sum / h.count * 1000:.0f}ms p95{p95_text}")
+            if timings:
+                lines.append(" | ".join(timings))
+            return lines
+
+
+class JsonLinesSink:
+    """ Appends one JSON object per finished job """
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, registry, job):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(job.to_dict()) + "\n")
+
+
+class PrometheusSink:
+    """ Rewrites a text-exposition file (e.g. for node_exporter's textfile collector) """
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, registry, job):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(registry.exposition())
+        os.replace(tmp, self.path)
+
+
+class MetricsRegistry:
+    """ Process-wide totals over every finished job, pushed to the configured sink """
+
+    def __init__(self):
+        self.phases = {phase: Histogram() for phase in PHASES}
+        self.errors = Counter()
+        self.jobs = Counter()
+        self.segments = 0
+        self.bytes = 0
+        self.retries = 0
+        self.gave_up = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.cache_hits = 0
+        self.sink = None
+        self._lock = threading.Lock()
+
+    def configure(self, kind, path):
+        with self._lock:
+            if kind == "json" and path:
+                self.sink = JsonLinesSink(path)
+            elif kind == "prometheus" and path:
+                self.sink = PrometheusSink(path)
+            else:
+                self.sink = None
+
+    def record_job(self, job):
+        with self._lock:
+            with job._lock:
+                for phase, h in job.phases.items():
+                    self.phases[phase].merge(h)
+                self.errors.update(job.errors)
+                self.segments += job.segments
+                self.bytes += job.bytes
+                self.retries += job.retries
+                self.gave_up += job.gave_up
+                self.hedges += job.hedges
+                self.hedge_wins += job.hedge_wins
+                self.cache_hits += job.cache_hits
+            self.jobs[job.result] += 1
+            sink = self.sink
+            if sink:
+                try:
+                    sink.export(self, job)
+                except OSError as e:
+                    print(f"[Metrics] Export failed: {e}", file=sys.stderr)
+
+    def exposition(self):
+        """ Prometheus text format of the totals; call with the lock held """
+        out = []
+
+        def metric(name, kind, help_text, samples):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(samples)
+
+        metric("m3u8_jobs_total", "counter", "Finished downloads by result.",
+               [f'm3u8_jobs_total{{result="{r}"}} {n}' for r, n in sorted(self.jobs.items())])
+        metric("m3u8_segments_total", "counter", "Segments downloaded.", [f"m3u8_segments_total {self.segments}"])
+        metric("m3u8_segment_bytes_total", "counter", "Segment bytes written.", [f"m3u8_segment_bytes_total {self.bytes}"])
+        metric("m3u8_segment_retries_total", "counter", "Failed segment attempts.", [f"m3u8_segment_retries_total {self.retries}"])
+        metric("m3u8_segments_given_up_total", "counter", "Segments that ran out of retries.",
+               [f"m3u8_segments_given_up_total {self.gave_up}"])
+        metric("m3u8_hedged_requests_total", "counter", "Duplicate requests raced against stragglers.",
+               [f"m3u8_hedged_requests_total {self.hedges}"])
+        metric("m3u8_hedge_wins_total", "counter", "Hedged requests that finished first.",
+               [f"m3u8_hedge_wins_total {self.hedge_wins}"])
+        metric("m3u8_cache_hits_total", "counter", "Segments served from the local segment cache.",
+               [f"m3u8_cache_hits_total {self.cache_hits}"])
+        metric("m3u8_segment_errors_total", "counter", "Failed attempts by cause.",
+               [f'm3u8_segment_errors_total{{cause="{c}"}} {n}' for c, n in sorted(self.errors.items())])
+
+        samples = []
+        for phase, h in self.phases.items():
+            cumulative = 0
+            for bound, c in zip([*map(str, BUCKETS), "+Inf"], h.counts):
+                cumulative += c
+                samples.append(f'm3u8_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+            samples.append(f'm3u8_phase_seconds_sum{{phase="{phase}"}} {h.sum}')
+            samples.append(f'm3u8_phase_seconds_count{{phase="{phase}"}} {h.count}')
+        metric("m3u8_phase_seconds", "histogram", "Time per segment phase (mux is per job).", samples)
+        return "\n".join(out) + "\n"
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = MetricsRegistry()
+            _apply_settings(settings.snapshot())
+            settings.subscribe(_apply_settings)
+        return _registry
+
+
+def _apply_settings(new_settings):
+    _registry.configure(new_settings["metrics_sink"], new_settings["metrics_path"])
@@ -0,0 +1,287 @@
+import os
+import subprocess
+import sys
+import threading
+
+# Read size for joins that can't stay in the kernel
+COPY_CHUNK = 1024 * 1024
+
+
+def ffmpeg_startupinfo():
+    startupinfo = None
+    if sys.platform == "win32":
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+    return startupinfo
+
+
+def _copy_file_range(src, dst, offset, remaining):
+    while remaining > 0:
+        n = os.copy_file_range(src, dst, remaining, offset)
+        if not n:
+            break
+        offset += n
+        remaining -= n
+    return remaining
+
+
+def _sendfile(src, dst, offset, remaining):
+    while remaining > 0:
+        n = os.sendfile(dst, src, offset, remaining)
+        if not n:
+            break
+        offset += n
+        remaining -= n
+    return remaining
+
+
+def append_range(dst, src, offset, length, zero_copy=True):
+    """
+    Append length bytes of src, an open binary file, from offset on to dst,
+    an unbuffered binary file. With zero_copy the bytes stay in the kernel
+    (copy_file_range, else sendfile) where the OS allows it; whatever those
+    can't move is copied the ordinary way.
+    """
+    remaining = length
+    if zero_copy:
+        for name, copy in (("copy_file_range", _copy_file_range), ("sendfile", _sendfile)):
+            if not remaining or not hasattr(os, name):
+                continue
+            try:
+                # Both advance the destination offset, so a fallback picks up where they stopped
+                remaining = copy(src.fileno(), dst.fileno(), offset + length - remaining, remaining)
+            except OSError:
+                continue
+    src.seek(offset + length - remaining)
+    while remaining:
+        data = src.read(min(COPY_CHUNK, remaining))
+        if not data:
+            raise OSError(f"{src.name} ended {remaining} bytes early")
+        write_all(dst, data)
+        remaining -= len(data)
+
+
+def append_file(dst, path, zero_copy=True):
+    """ Append the whole file at path to dst (see append_range) """
+    with open(path, "rb") as src:
+        append_range(dst, src, 0, os.fstat(src.fileno()).st_size, zero_copy)
+
+
+def write_all(dst, data):
+    view = memoryview(data)
+    while view:
+        view = view[dst.write(view):]
+
+
+def concat_segments(output_path, parts, zero_copy=True):
+    """
+    Join parts, in order, into output_path without ffmpeg. A part is either
+    bytes written as-is (an init segment), the path of a segment file or a
+    (path, offset, length) region of one, such as a SegmentStore entry.
+    """
+    tmp = output_path + ".part"
+    sources = {}
+    try:
+        with open(tmp, "wb", buffering=0) as out:
+            for part in parts:
+                if isinstance(part, bytes):
+                    write_all(out, part)
+                elif isinstance(part, tuple):
+                    path, offset, length = part
+                    if path not in sources:
+                        sources[path] = open(path, "rb")
+                    append_range(out, sources[path], offset, length, zero_copy)
+                else:
+                    append_file(out, part, zero_copy)
+        os.replace(tmp, output_path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        for src in sources.values():
+            src.close()
+
+
+class StreamMuxer:
+    """
+    Feeds finished segments to one long-running ffmpeg over stdin, in playlist order.
+    Out-of-order segments wait in an in-memory reorder buffer until the gap before
+    them is filled; fetchers call wait_for_room() so that buffer stays bounded.
+    total may be None for a live stream and set later with set_total().
+    inits maps a segment index to its EXT-X-MAP init segment, which is written
+    ahead of the first segment that uses it.
+    """
+
+    WRITE_ERROR = "FFmpeg stopped accepting data"
+
+    def __init__(self, ffmpeg, output_path, total, window=32, inits=None):
+        self.output_path = output_path
+        self.total = total
+        self.window = window
+        self.inits = inits if inits is not None else {}
+        self.error = None
+        self.proc = None
+
+        self._pending = {}
+        self._next = 0
+        self._closed = False
+        self._init = None
+        self._cond = threading.Condition()
+        self._stderr = b""
+
+        self._sink = self._open(ffmpeg)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _open(self, ffmpeg):
+        cmd = [ffmpeg, "-y", "-loglevel", "error", "-i", "pipe:0", "-c", "copy", self.output_path]
+        self.proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            startupinfo=ffmpeg_startupinfo()
+        )
+        # stderr must be drained or ffmpeg blocks once the pipe buffer fills
+        self._stderr_thread = threading.Thread(target=self._read_stderr, daemon=True)
+        self._stderr_thread.start()
+        return self.proc.stdin
+
+    def running(self):
+        return self.proc.poll() is None
+
+    def _read_stderr(self):
+        self._stderr = self.proc.stderr.read()
+
+    def set_total(self, total):
+        with self._cond:
+            self.total = total
+            self._cond.notify_all()
+
+    def _done(self):
+        return self.total is not None and self._next >= self.total
+
+    def has_room(self, i):
+        return i - self._next < self.window or self._closed
+
+    def wait_for_room(self, i, should_stop):
+        """ Block a fetcher until segment i fits in the reorder window """
+        with self._cond:
+            while not self.has_room(i) and not should_stop():
+                self._cond.wait(0.5)
+
+    def feed(self, i, data):
+        with self._cond:
+            if self._closed:
+                return
+            self._pending[i] = data
+            self._cond.notify_all()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while self._next not in self._pending and not self._closed and not self._done():
+                    self._cond.wait()
+                if self._next not in self._pending:
+                    return
+                data = self._pending.pop(self._next)
+
+            try:
+                init = self.inits.get(self._next)
+                if init is not None and init is not self._init:
+                    self._sink.write(init)
+                    self._init = init
+                self._sink.write(data)
+            except (BrokenPipeError, OSError) as e:
+                with self._cond:
+                    self.error = f"{self.WRITE_ERROR}: {e}"
+                    self._closed = True
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                self._next += 1
+                self._cond.notify_all()
+                if self._done():
+                    return
+
+    def finish(self):
+        """ Wait for every segment to be written, close stdin and return (returncode, stderr) """
+        self._writer.join()
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        returncode = self.proc.wait()
+        self._stderr_thread.join()
+        err = self._stderr.decode(errors="replace").strip()
+        if self.error:
+            err = f"{self.error}\n{err}".strip()
+        if returncode == 0 and not self._done():
+            returncode = 1
+            err = err or f"Only {self._next}/{self.total} segments reached FFmpeg"
+        return returncode, err
+
+    def abort(self):
+        with self._cond:
+            self._closed = True
+            self._pending.clear()
+            self._cond.notify_all()
+        try:
+            self.proc.kill()
+        except OSError:
+            pass
+        self.proc.wait()
+        if os.path.exists(self.output_path):
+            try:
+                os.remove(self.output_path)
+            except OSError:
+                pass
+
+
+class NativeStreamMuxer(StreamMuxer):
+    """
+    StreamMuxer for output in the stream's own container: segments are
+    appended to the file in-process, no ffmpeg involved.
+    """
+
+    WRITE_ERROR = "Writing the output failed"
+
+    def _open(self, ffmpeg):
+        self._part = self.output_path + ".part"
+        return open(self._part, "wb")
+
+    def running(self):
+        return not self._sink.closed
+
+    def finish(self):
+        self._writer.join()
+        try:
+            self._sink.close()
+        except OSError as e:
+            self.error = self.error or f"{self.WRITE_ERROR}: {e}"
+        if self.error:
+            self._remove_part()
+            return 1, self.error
+        if not self._done():
+            self._remove_part()
+            return 1, f"Only {self._next}/{self.total} segments were written"
+        os.replace(self._part, self.output_path)
+        return 0, ""
+
+    def _remove_part(self):
+        if os.path.exists(self._part):
+            try:
+                os.remove(self._part)
+            except OSError:
+                pass
+
+    def abort(self):
+        with self._cond:
+            self._closed = True
+            self._pending.clear()
+            self._cond.notify_all()
+        self._writer.join()
+        self._sink.close()
+        self._remove_part()
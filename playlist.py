@@ -0,0 +1,137 @@
+import re
+from urllib.parse import urljoin
+import m3u8
+
+# Segments parsed per step of MediaPlaylist.parse()
+PARSE_BATCH = 500
+
+_ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+_ENDLIST = re.compile(r"^#EXT-X-ENDLIST", re.MULTILINE)
+
+
+def parse_attributes(value):
+    """ 'METHOD=AES-128,URI="k.bin"' -> {"METHOD": "AES-128", "URI": "k.bin"} """
+    return {name: v.strip('"') for name, v in _ATTRIBUTE.findall(value)}
+
+
+class UriJoiner:
+    """ urljoin against one base, short-cutting the plain relative names most playlists use """
+
+    def __init__(self, base):
+        self.base = base or ""
+        path = self.base.split("?", 1)[0].split("#", 1)[0]
+        self.directory = path[:path.rfind("/") + 1] if "://" in path else ""
+
+    def __call__(self, uri):
+        if "://" in uri:
+            return uri
+        plain = uri[0] not in "/.?#" and "/." not in uri and ":" not in uri.split("/", 1)[0]
+        if self.directory and plain:
+            return self.directory + uri
+        return urljoin(self.base, uri)
+
+
+class Key:
+    def __init__(self, attributes, joiner):
+        self.method = attributes.get("METHOD")
+        self.uri = attributes.get("URI")
+        self.iv = attributes.get("IV")
+        self.absolute_uri = joiner(self.uri) if self.uri else None
+
+
+class InitSection:
+    def __init__(self, attributes, joiner):
+        self.uri = attributes.get("URI")
+        self.byterange = attributes.get("BYTERANGE")
+        self.absolute_uri = joiner(self.uri) if self.uri else None
+
+
+class Segment:
+    __slots__ = ("uri", "absolute_uri", "duration", "byterange", "key", "init_section")
+
+    def __init__(self, uri, absolute_uri, duration, byterange, key, init_section):
+        self.uri = uri
+        self.absolute_uri = absolute_uri
+        self.duration = duration
+        self.byterange = byterange
+        self.key = key
+        self.init_section = init_section
+
+
+class MediaPlaylist:
+    """
+    A media playlist read line by line, keeping only what the downloader
+    uses (the same attribute names as m3u8's objects, which cost far more
+    per segment). Segments are parsed by parse(), in batches, so a job can
+    start on the first ones while the rest of a huge playlist is still being
+    read. The header tags come before the first segment, so they are set by
+    the first batch; the end tag and the segment count are looked up front.
+    """
+
+    is_variant = False
+    playlists = []
+
+    def __init__(self, text, uri):
+        self.uri = uri
+        self.segments = []
+        self.media_sequence = None
+        self.target_duration = None
+        self.is_endlist = _ENDLIST.search(text) is not None
+        # Every segment has an #EXTINF, so this is the count before any is parsed
+        self.segment_count = text.count("#EXTINF")
+        self._lines = text.splitlines()
+        self._pos = 0
+        self._join = UriJoiner(uri)
+        self._duration = None
+        self._byterange = None
+        self._key = None
+        self._init = None
+
+    @property
+    def parsed(self):
+        return self._pos >= len(self._lines)
+
+    def parse(self, batch=PARSE_BATCH):
+        """ Parse the rest, yielding (index of the first new segment, new segments) every batch segments """
+        while not self.parsed:
+            first = len(self.segments)
+            self._parse(first + batch)
+            if len(self.segments) > first:
+                yield first, self.segments[first:]
+
+    def _parse(self, limit):
+        lines = self._lines
+        while self._pos < len(lines) and len(self.segments) < limit:
+            line = lines[self._pos].strip()
+            self._pos += 1
+            if not line:
+                continue
+            if line[0] != "#":
+                self.segments.append(Segment(line, self._join(line), self._duration, self._byterange, self._key, self._init))
+                self._duration = self._byterange = None
+            elif line.startswith("#EXTINF:"):
+                self._duration = float(line[8:].split(",", 1)[0] or 0)
+            elif line.startswith("#EXT-X-BYTERANGE:"):
+                self._byterange = line[17:]
+            elif line.startswith("#EXT-X-KEY:"):
+                self._key = Key(parse_attributes(line[11:]), self._join)
+            elif line.startswith("#EXT-X-MAP:"):
+                self._init = InitSection(parse_attributes(line[11:]), self._join)
+            elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+                self.media_sequence = int(line[22:])
+            elif line.startswith("#EXT-X-TARGETDURATION:"):
+                self.target_duration = float(line[22:])
+
+
+def loads(text, uri, lazy=False):
+    """
+    Parse a playlist: an m3u8 object for a master playlist, a MediaPlaylist
+    otherwise. lazy leaves the segments of a media playlist to parse().
+    """
+    if "#EXT-X-STREAM-INF" in text:
+        return m3u8.loads(text, uri=uri)
+    playlist = MediaPlaylist(text, uri)
+    if not lazy:
+        for _ in playlist.parse():
+            pass
+    return playlist
@@ -0,0 +1,62 @@
+import math
+import threading
+import time
+
+# How often the GUI applies queued progress updates (5 Hz)
+REFRESH_INTERVAL = 0.2
+
+
+class EwmaRate:
+    """
+    Exponentially weighted rate of a growing counter (bytes, media seconds...).
+    Samples closer together than `interval` are folded into the next one, so
+    bursts of tiny segments don't make the rate jump around.
+    """
+
+    def __init__(self, halflife=3.0, interval=0.5):
+        self.halflife = halflife
+        self.interval = interval
+        self.rate = 0.0
+        self._last_time = None
+        self._last_total = 0
+
+    def update(self, total, now=None):
+        now = time.monotonic() if now is None else now
+        if self._last_time is None:
+            self._last_time, self._last_total = now, total
+            return self.rate
+        elapsed = now - self._last_time
+        if elapsed < self.interval:
+            return self.rate
+        sample = (total - self._last_total) / elapsed
+        # Weight the new sample by how much time it covers
+        alpha = 1 - math.exp(-elapsed * math.log(2) / self.halflife)
+        self.rate = sample if self.rate == 0 else self.rate + alpha * (sample - self.rate)
+        self._last_time, self._last_total = now, total
+        return self.rate
+
+
+class ProgressAggregator:
+    """
+    Latest progress per job, written from any worker thread and drained in
+    one batch by the GUI on a timer. Only the newest update of each job is
+    kept, so a job finishing hundreds of segments a second costs one redraw
+    per tick instead of one Tk callback per segment.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def publish(self, name, *update):
+        with self._lock:
+            self._pending[name] = update
+
+    def discard(self, name):
+        with self._lock:
+            self._pending.pop(name, None)
+
+    def drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
@@ -0,0 +1,77 @@
+import threading
+import time
+from settings import store as settings
+
+# Burst a bucket allows after sitting idle, in seconds of its rate
+BURST_SECONDS = 0.25
+# ...but never less than a read chunk, so a slow limit still lets whole chunks through
+MIN_BURST = 64 * 1024
+
+
+class TokenBucket:
+    """
+    A bytes/s limit shared by every connection reading against it. Each chunk
+    read is taken from the bucket even when it runs the bucket into debt; the
+    reader then waits until the debt is paid back at the bucket's rate. So a
+    chunk bigger than the burst still goes through, readers queue in the
+    order they read, and together they stay at the rate however many there
+    are. A rate of 0 is no limit.
+    """
+
+    def __init__(self, rate=0):
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self.rate = 0
+        self.burst = MIN_BURST
+        # Bumped by every rate change, so readers waiting out the old rate can stop early
+        self.version = 0
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            if rate == self.rate:
+                return
+            self._refill()
+            self.rate = rate
+            self.burst = max(rate * BURST_SECONDS, MIN_BURST)
+            # Debt run up at the old rate is dropped; the next chunks pay at the new one
+            self._tokens = min(max(self._tokens, 0.0), self.burst)
+            self.version += 1
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def take(self, nbytes):
+        """ Take nbytes just read; returns the seconds to wait before reading on """
+        with self._lock:
+            if not self.rate:
+                return 0.0
+            self._refill()
+            self._tokens -= nbytes
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+
+def kbs_rate(kbs):
+    return kbs * 1024
+
+
+_bucket = None
+_bucket_lock = threading.Lock()
+
+
+def get_bandwidth_limiter():
+    """ The bucket every download reads through, at max_download_kbs """
+    global _bucket
+    with _bucket_lock:
+        if _bucket is None:
+            _bucket = TokenBucket(kbs_rate(settings.get("max_download_kbs", 0)))
+            settings.subscribe(_apply_settings)
+        return _bucket
+
+
+def _apply_settings(new_settings):
+    _bucket.set_rate(kbs_rate(new_settings["max_download_kbs"]))
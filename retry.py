@@ -0,0 +1,151 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from concurrency import THROTTLE_STATUSES
+from keys import DecryptionError
+from settings import store as settings
+
+# Statuses that will not change on a retry: the segment is gone or forbidden
+FATAL_STATUSES = {400, 401, 403, 404, 405, 410, 451}
+
+FATAL = "fatal"
+THROTTLE = "throttle"
+TRANSIENT = "transient"
+
+
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Decides whether a failed segment attempt is worth repeating and how long
+    to wait first: exponential backoff with full jitter, or the server's
+    Retry-After when it sent one. Both are capped at max_delay.
+    """
+
+    def __init__(self, base_delay=0.5, max_delay=30.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def classify(self, e):
+        if isinstance(e, DecryptionError):
+            return FATAL
+        status = getattr(e, "status", None)
+        if status in FATAL_STATUSES:
+            return FATAL
+        if status in THROTTLE_STATUSES:
+            return THROTTLE
+        return TRANSIENT
+
+    def delay(self, attempt, e=None):
+        retry_after = parse_retry_after(getattr(e, "retry_after", None))
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Per-host breaker shared by every download. After `threshold` failures in
+    a row the host is left alone for `cooldown` seconds; then one request is
+    let through, and its result either closes the breaker or reopens it for
+    twice as long (up to 8x the cooldown).
+    """
+
+    def __init__(self, threshold=5, cooldown=10.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._open_until = 0.0
+        self._trips = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ True if a request may go to the host now """
+        with self._lock:
+            if self._failures < self.threshold:
+                return True
+            if time.monotonic() < self._open_until or self._probing:
+                return False
+            # Half-open: this caller is the probe
+            self._probing = True
+            return True
+
+    def is_open(self):
+        """ True while requests to the host are being held back; unlike allow() it never claims the probe """
+        with self._lock:
+            return self._failures >= self.threshold and (time.monotonic() < self._open_until or self._probing)
+
+    def wait(self, should_stop):
+        while not self.allow():
+            if should_stop():
+                return False
+            time.sleep(0.2)
+        return True
+
+    async def wait_async(self, should_stop):
+        while not self.allow():
+            if should_stop():
+                return False
+            await asyncio.sleep(0.2)
+        return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trips = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            was_probe = self._probing
+            self._failures += 1
+            self._probing = False
+            # Trip when crossing the threshold or when the half-open probe fails, not on
+            # every late failure from requests that were already in flight
+            if self._failures == self.threshold or (was_probe and self._failures > self.threshold):
+                self._open_until = time.monotonic() + self.cooldown * min(2 ** self._trips, 8)
+                self._trips += 1
+
+    def release(self):
+        """ Give up a probe slot without a verdict (the attempt was cancelled) """
+        with self._lock:
+            self._probing = False
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host):
+    # Read before taking the lock: settings.get() may notify _apply_settings, which takes it too
+    threshold = settings.get("circuit_breaker_threshold", 5)
+    cooldown = settings.get("circuit_breaker_cooldown", 10.0)
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(threshold, cooldown)
+        return breaker
+
+
+def _apply_settings(new_settings):
+    with _breakers_lock:
+        for breaker in _breakers.values():
+            breaker.threshold = new_settings["circuit_breaker_threshold"]
+            breaker.cooldown = new_settings["circuit_breaker_cooldown"]
+
+
+settings.subscribe(_apply_settings)
@@ -0,0 +1,113 @@
+import asyncio
+import threading
+from collections import defaultdict
+from settings import store as settings
+
+
+class ConnectionScheduler:
+    """
+    Process-wide budget of segment requests shared by every download.
+    A slot needs room under both the global cap and the host's cap; when
+    several jobs are waiting for the same kind of slot, the job currently
+    holding the fewest slots gets it, so one big download can't starve the rest.
+    """
+
+    def __init__(self, global_limit=128, per_host_limit=32):
+        self.global_limit = global_limit
+        self.per_host_limit = per_host_limit
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._host_inflight = defaultdict(int)
+        self._held = defaultdict(int)      # job -> slots held
+        self._waiting = defaultdict(int)   # (job, host) -> waiters
+
+    def set_limits(self, global_limit, per_host_limit):
+        with self._cond:
+            self.global_limit = global_limit
+            self.per_host_limit = per_host_limit
+            self._cond.notify_all()
+
+    def _has_room(self, host):
+        return self._inflight < self.global_limit and self._host_inflight.get(host, 0) < self.per_host_limit
+
+    def _try_grant(self, job, host):
+        if not self._has_room(host):
+            return False
+        # Fair share: only the least-served job among those that could use this slot may take it
+        held = self._held.get(job, 0)
+        fewest = min(
+            (self._held.get(j, 0) for (j, h), n in self._waiting.items() if n and self._has_room(h)),
+            default=held
+        )
+        if held > fewest:
+            return False
+        self._inflight += 1
+        self._host_inflight[host] += 1
+        self._held[job] += 1
+        return True
+
+    def acquire(self, job, host, should_stop):
+        """ Block until a slot for host is granted; returns False if should_stop() became true first """
+        with self._cond:
+            self._waiting[(job, host)] += 1
+            try:
+                while not self._try_grant(job, host):
+                    if should_stop():
+                        return False
+                    self._cond.wait(0.5)
+                return True
+            finally:
+                self._leave(job, host)
+
+    async def acquire_async(self, job, host, should_stop):
+        """ Same as acquire() for the asyncio engine, polling instead of blocking the loop """
+        with self._cond:
+            self._waiting[(job, host)] += 1
+        try:
+            while True:
+                with self._cond:
+                    if self._try_grant(job, host):
+                        return True
+                if should_stop():
+                    return False
+                await asyncio.sleep(0.02)
+        finally:
+            with self._cond:
+                self._leave(job, host)
+
+    def _leave(self, job, host):
+        self._waiting[(job, host)] -= 1
+        if not self._waiting[(job, host)]:
+            del self._waiting[(job, host)]
+
+    def release(self, job, host):
+        with self._cond:
+            self._inflight = max(0, self._inflight - 1)
+            self._host_inflight[host] = self._host_inflight.get(host, 1) - 1
+            if self._host_inflight[host] <= 0:
+                del self._host_inflight[host]
+            self._held[job] = self._held.get(job, 1) - 1
+            if self._held[job] <= 0:
+                del self._held[job]
+            self._cond.notify_all()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ConnectionScheduler(
+                settings.get("global_max_connections", 128),
+                settings.get("per_host_connections", 32)
+            )
+            # Budget changes in the settings apply to downloads already running
+            settings.subscribe(_apply_settings)
+        return _scheduler
+
+
+def _apply_settings(new_settings):
+    _scheduler.set_limits(new_settings["global_max_connections"], new_settings["per_host_connections"])
@@ -0,0 +1,236 @@
+import atexit
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from http_pool import response_validators
+from settings import store as settings
+
+INDEX_FILE = "index.json"
+BLOB_DIR = "blobs"
+CACHE_VERSION = 1
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".m3u8_downloader_cache")
+
+
+def cache_key(url, byterange=None):
+    """ One entry per absolute segment URL, and per (start, length) byte range of it """
+    return f"{url}#{byterange[0]}+{byterange[1]}" if byterange else url
+
+
+def segment_validators(url, headers):
+    """ The URL a body was fetched from plus that response's ETag / Last-Modified; None without either """
+    validators = response_validators(headers)
+    if not any(validators.values()):
+        return None
+    return dict(validators, url=url)
+
+
+class SegmentCache:
+    """
+    Segment bodies as served (still encrypted, if they are), kept across jobs.
+    Blobs are content-addressed: stored once under their SHA-256 however many
+    URLs returned them, so ad and slate segments shared between playlists
+    take their space once. Entries map a segment URL (and byte range) to a
+    blob and the validators of the response it came from. Once the blobs add
+    up to more than max_bytes, the least recently used ones go first.
+
+    The index is only written by save(). Blobs that a crash or another
+    process left out of it are picked up on load and evicted first.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        # cache key -> (digest, validators), and the keys pointing at each blob
+        self._entries = {}
+        self._users = {}
+        # digest -> size, least recently used first
+        self._blobs = OrderedDict()
+        self._size = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _blob_path(self, digest):
+        return os.path.join(self.path, BLOB_DIR, digest[:2], digest)
+
+    def _load(self):
+        on_disk = {}
+        for root, _, files in os.walk(os.path.join(self.path, BLOB_DIR)):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if name.endswith(".tmp"):
+                        os.remove(path)
+                    else:
+                        on_disk[name] = os.path.getsize(path)
+                except OSError:
+                    pass
+        try:
+            with open(os.path.join(self.path, INDEX_FILE), "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("version") != CACHE_VERSION:
+                index = {}
+        except (OSError, ValueError):
+            index = {}
+
+        indexed = [digest for digest in index.get("blobs", []) if digest in on_disk]
+        known = set(indexed)
+        for digest in [d for d in on_disk if d not in known] + indexed:
+            self._blobs[digest] = on_disk[digest]
+            self._size += on_disk[digest]
+        for key, (digest, validators) in index.get("entries", {}).items():
+            if digest in known:
+                self._entries[key] = (digest, validators)
+                self._users.setdefault(digest, set()).add(key)
+        self._evict()
+
+    def get(self, url, byterange=None):
+        """ (body, validators) cached for url, or None """
+        with self._lock:
+            entry = self._entries.get(cache_key(url, byterange))
+        if not entry:
+            return None
+        digest, validators = entry
+        try:
+            with open(self._blob_path(digest), "rb") as f:
+                data = f.read()
+        except OSError:
+            data = None
+        with self._lock:
+            if data is None or len(data) != self._blobs.get(digest):
+                # Evicted meanwhile, or damaged on disk
+                self._drop(digest)
+                return None
+            self._blobs.move_to_end(digest)
+            self._dirty = True
+        return data, validators
+
+    def put(self, url, byterange, data, validators=None):
+        if len(data) > self.max_bytes:
+            return
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            stored = digest in self._blobs
+        if not stored:
+            path = self._blob_path(digest)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except OSError as e:
+                print(f"[Cache] Could not store {url}: {e}", file=sys.stderr)
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                return
+
+        key = cache_key(url, byterange)
+        with self._lock:
+            old = self._entries.get(key)
+            if old and old[0] != digest:
+                # The URL serves something else now; the old blob stays until it is evicted
+                self._users[old[0]].discard(key)
+            if digest not in self._blobs:
+                self._blobs[digest] = len(data)
+                self._size += len(data)
+            self._blobs.move_to_end(digest)
+            self._entries[key] = (digest, validators)
+            self._users.setdefault(digest, set()).add(key)
+            self._dirty = True
+            self._evict()
+
+    def set_limit(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._blobs:
+            self._drop(next(iter(self._blobs)))
+
+    def _drop(self, digest):
+        size = self._blobs.pop(digest, None)
+        if size is None:
+            return
+        self._size -= size
+        for key in self._users.pop(digest, ()):
+            self._entries.pop(key, None)
+        self._dirty = True
+        try:
+            os.remove(self._blob_path(digest))
+        except OSError:
+            pass
+
+    def save(self):
+        """ Write the index (entries and LRU order) if anything changed since the last save """
+        with self._lock:
+            if not self._dirty:
+                return
+            index = {
+                "version": CACHE_VERSION,
+                "blobs": list(self._blobs),
+                "entries": {key: [digest, validators] for key, (digest, validators) in self._entries.items()}
+            }
+            self._dirty = False
+        path = os.path.join(self.path, INDEX_FILE)
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(index, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"[Cache] Could not save the index: {e}", file=sys.stderr)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_configured = False
+
+
+def get_segment_cache():
+    """ The process-wide segment cache, or None while segment_cache_mb is 0 """
+    global _configured
+    with _cache_lock:
+        if not _configured:
+            _configure(settings.snapshot())
+            settings.subscribe(_apply_settings)
+            atexit.register(_save)
+            _configured = True
+        return _cache
+
+
+def _configure(new_settings):
+    global _cache
+    max_bytes = new_settings["segment_cache_mb"] * 1024 * 1024
+    path = new_settings["cache_dir"] or default_cache_dir()
+    if _cache and (not max_bytes or _cache.path != path):
+        _cache.save()
+        _cache = None
+    if not max_bytes:
+        return
+    if _cache:
+        _cache.set_limit(max_bytes)
+        return
+    try:
+        os.makedirs(path, exist_ok=True)
+        _cache = SegmentCache(path, max_bytes)
+    except OSError as e:
+        print(f"[Cache] Disabled, {path} is not usable: {e}", file=sys.stderr)
+
+
+def _apply_settings(new_settings):
+    # Jobs already running keep the cache they started with
+    with _cache_lock:
+        _configure(new_settings)
+
+
+def _save():
+    with _cache_lock:
+        if _cache:
+            _cache.save()
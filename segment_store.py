@@ -0,0 +1,138 @@
+import os
+import threading
+
+DATA_FILE = "segments.dat"
+# Smallest step the data file grows by; it is extended ahead of the writes, not by them
+PREALLOCATE_STEP = 64 * 1024 * 1024
+# Regions given back smaller than this (padding trimmed off a decrypted segment) aren't worth tracking
+MIN_FREE_REGION = 64 * 1024
+
+
+def _pwrite(fd, data, offset, lock):
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+        return
+    # No positional I/O (Windows): seek + write under the store's lock
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def _pread(fd, length, offset, lock):
+    if hasattr(os, "pread"):
+        return os.pread(fd, length, offset)
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+
+
+class SegmentStore:
+    """
+    Every segment of a job in one sparse file instead of a file each. Writers
+    reserve a region, fill it with positional writes (so any number of them
+    can write at once) and commit (offset, length) to the index, which the
+    join and the resume read back. The file is grown ahead of the writes in
+    large steps, sized from the segments committed so far once there are
+    some. Unused regions (the tail of a body shorter than its Content-Length,
+    one a growing segment moved out of) are given back with release() and
+    reused by later reservations.
+    """
+
+    def __init__(self, segment_dir, expected=None):
+        self.path = os.path.join(segment_dir, DATA_FILE)
+        # Segment count of the job, to size the file from; None while it isn't known (live)
+        self.expected = expected
+        self.index = {}
+        self._fd = None
+        self._end = 0
+        self._size = 0
+        self._committed = 0
+        # (offset, size) of released regions, handed out again before the file grows
+        self._free = []
+        self._lock = threading.Lock()
+
+    def open(self, index=None):
+        """ Open (or create) the data file; index holds segments kept from an earlier run """
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        self._fd = os.open(self.path, flags)
+        self.index = dict(index or {})
+        self._size = os.fstat(self._fd).st_size
+        # New regions go after every kept one; anything past them was never committed
+        self._end = max((offset + length for offset, length in self.index.values()), default=0)
+        self._committed = sum(length for _, length in self.index.values())
+
+    def reserve(self, size):
+        """ Offset of a fresh region of size bytes """
+        with self._lock:
+            for n, (offset, free) in enumerate(self._free):
+                if free >= size:
+                    if free - size >= MIN_FREE_REGION:
+                        self._free[n] = (offset + size, free - size)
+                    else:
+                        del self._free[n]
+                    return offset
+            offset = self._end
+            self._end += size
+            if self._end > self._size:
+                self._grow()
+            return offset
+
+    def release(self, offset, size):
+        """ Give back a reserved region, or the unused end of one """
+        with self._lock:
+            if offset + size == self._end:
+                self._end = offset
+            elif size >= MIN_FREE_REGION:
+                self._free.append((offset, size))
+
+    def _grow(self):
+        if self.expected and self.index:
+            # From what segments really take, not from reservations, which a body can fall short of
+            target = max(self._end + PREALLOCATE_STEP, self._committed // len(self.index) * self.expected)
+        else:
+            target = self._size + max(PREALLOCATE_STEP, self._size // 2)
+        self._size = max(self._end, target)
+        # Only sets the length: the file stays sparse until the regions are written
+        os.ftruncate(self._fd, self._size)
+
+    def write(self, offset, data):
+        _pwrite(self._fd, data, offset, self._lock)
+
+    def read(self, offset, length):
+        return _pread(self._fd, length, offset, self._lock)
+
+    def copy(self, src, dst, length, chunk=1024 * 1024):
+        """ Move length bytes at src to dst, for a region that outgrew its reservation """
+        done = 0
+        while done < length:
+            data = self.read(src + done, min(chunk, length - done))
+            if not data:
+                break
+            self.write(dst + done, data)
+            done += len(data)
+
+    def put(self, data):
+        """ Store one whole segment; returns its (offset, length) """
+        offset = self.reserve(len(data))
+        self.write(offset, data)
+        return offset, len(data)
+
+    def commit(self, i, offset, length):
+        with self._lock:
+            old = self.index.get(i)
+            if old:
+                self._committed -= old[1]
+            self.index[i] = (offset, length)
+            self._committed += length
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
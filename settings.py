@@ -1,5 +1,10 @@
+import copy
 import json
 import os
+import sys
+import threading
+import time
+from variants import VALID_VARIANT_POLICIES
 
 SETTINGS_FILE = "m3u8_downloader_settings.json"
 
@@ -9,42 +14,286 @@ DEFAULTS = {
     "max_parallel": 5,
     "ffmpeg_path": "ffmpeg",
     "theme": "dark",
-    "enable_notifications": True 
+    "enable_notifications": True,
+    "engine": "threads",
+    "async_max_inflight": 256,
+    "stream_mux": False,
+    "cpu_workers": 0,
+    "cpu_queue_depth": 0,
+    "output_format": "mp4",
+    "zero_copy_join": True,
+    "segment_cache_mb": 0,
+    "cache_dir": "",
+    "cache_revalidate": False,
+    "max_download_kbs": 0,
+    "job_max_download_kbs": 0,
+    "adaptive_connections": False,
+    "max_connections": 64,
+    "global_max_connections": 128,
+    "per_host_connections": 32,
+    "variant_policy": "highest",
+    "max_resolution": 1080,
+    "variant_target_seconds": 600,
+    "max_range_bytes": 8 * 1024 * 1024,
+    "timeout": 10,
+    "max_retries": 3,
+    "retry_base_delay": 0.5,
+    "retry_max_delay": 30,
+    "circuit_breaker_threshold": 5,
+    "circuit_breaker_cooldown": 10,
+    "hedge_requests": True,
+    "hedge_factor": 3.0,
+    "hedge_min_seconds": 2.0,
+    "multi_source": True,
+    "mirrors": [],
+    "metrics_sink": "none",
+    "metrics_path": ""
 }
 
 VALID_THREADS = [1, 2, 4, 8, 16, 32]
 MIN_PARALLEL = 1
 MAX_PARALLEL = 10
+VALID_ENGINES = ["threads", "asyncio"]
+VALID_METRICS_SINKS = ["none", "json", "prometheus"]
+# "native" keeps TS/AAC streams in their own container instead of remuxing to MP4
+VALID_OUTPUT_FORMATS = ["mp4", "native"]
+MAX_ADAPTIVE_CONNECTIONS = 256
 
-def load_settings():
-    if not os.path.exists(SETTINGS_FILE):
-        save_settings(DEFAULTS)
-        return DEFAULTS.copy()
+def validate_settings(settings):
+    """ Fill in missing keys and replace invalid values with defaults (in place) """
+    # Fill missing keys with defaults
+    for key, val in DEFAULTS.items():
+        if key not in settings:
+            settings[key] = copy.deepcopy(val)
+
+    # Validate num_connections
+    if settings.get("num_connections") not in VALID_THREADS:
+        settings["num_connections"] = DEFAULTS["num_connections"]
+
+    # Validate max_parallel
+    max_par = settings.get("max_parallel")
+    if not isinstance(max_par, int) or not (MIN_PARALLEL <= max_par <= MAX_PARALLEL):
+        settings["max_parallel"] = DEFAULTS["max_parallel"]
+
+    # Validate engine
+    if settings.get("engine") not in VALID_ENGINES:
+        settings["engine"] = DEFAULTS["engine"]
+    inflight = settings.get("async_max_inflight")
+    if not isinstance(inflight, int) or isinstance(inflight, bool) or inflight <= 0:
+        settings["async_max_inflight"] = DEFAULTS["async_max_inflight"]
+
+    # Validate adaptive connection cap
+    max_conn = settings.get("max_connections")
+    if not isinstance(max_conn, int) or not (1 <= max_conn <= MAX_ADAPTIVE_CONNECTIONS):
+        settings["max_connections"] = DEFAULTS["max_connections"]
+
+    # Validate connection budget shared by all downloads
+    for key in ("global_max_connections", "per_host_connections"):
+        val = settings.get(key)
+        if not isinstance(val, int) or not (1 <= val <= MAX_ADAPTIVE_CONNECTIONS * MAX_PARALLEL):
+            settings[key] = DEFAULTS[key]
+
+    # Validate variant selection
+    if settings.get("variant_policy") not in VALID_VARIANT_POLICIES:
+        settings["variant_policy"] = DEFAULTS["variant_policy"]
+    for key in ("max_resolution", "variant_target_seconds"):
+        val = settings.get(key)
+        if not isinstance(val, int) or val <= 0:
+            settings[key] = DEFAULTS[key]
+
+    # Validate byte-range coalescing cap
+    if not isinstance(settings.get("max_range_bytes"), int) or settings["max_range_bytes"] <= 0:
+        settings["max_range_bytes"] = DEFAULTS["max_range_bytes"]
+
+    # Validate request timeout and retry count (both apply to running downloads)
+    timeout = settings.get("timeout")
+    if not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout <= 0:
+        settings["timeout"] = DEFAULTS["timeout"]
+    retries = settings.get("max_retries")
+    if not isinstance(retries, int) or isinstance(retries, bool) or retries < 0:
+        settings["max_retries"] = DEFAULTS["max_retries"]
+
+    # Validate backoff and circuit breaker
+    for key in ("retry_base_delay", "retry_max_delay", "circuit_breaker_cooldown"):
+        val = settings.get(key)
+        if not isinstance(val, (int, float)) or isinstance(val, bool) or val <= 0:
+            settings[key] = DEFAULTS[key]
+    threshold = settings.get("circuit_breaker_threshold")
+    if not isinstance(threshold, int) or isinstance(threshold, bool) or threshold < 1:
+        settings["circuit_breaker_threshold"] = DEFAULTS["circuit_breaker_threshold"]
+
+    # Validate straggler hedging
+    if not isinstance(settings.get("hedge_requests"), bool):
+        settings["hedge_requests"] = DEFAULTS["hedge_requests"]
+    for key in ("hedge_factor", "hedge_min_seconds"):
+        val = settings.get(key)
+        if not isinstance(val, (int, float)) or isinstance(val, bool) or val <= 0:
+            settings[key] = DEFAULTS[key]
+
+    # Validate the decrypt/write pool (0 = sized to the cores)
+    for key in ("cpu_workers", "cpu_queue_depth"):
+        val = settings.get(key)
+        if not isinstance(val, int) or isinstance(val, bool) or val < 0:
+            settings[key] = DEFAULTS[key]
+
+    # Validate output container
+    if settings.get("output_format") not in VALID_OUTPUT_FORMATS:
+        settings["output_format"] = DEFAULTS["output_format"]
+    if not isinstance(settings.get("zero_copy_join"), bool):
+        settings["zero_copy_join"] = DEFAULTS["zero_copy_join"]
+
+    # Validate the segment cache (0 MB = off; an empty dir means the default location)
+    cache_mb = settings.get("segment_cache_mb")
+    if not isinstance(cache_mb, int) or isinstance(cache_mb, bool) or cache_mb < 0:
+        settings["segment_cache_mb"] = DEFAULTS["segment_cache_mb"]
+    if not isinstance(settings.get("cache_dir"), str):
+        settings["cache_dir"] = DEFAULTS["cache_dir"]
+    if not isinstance(settings.get("cache_revalidate"), bool):
+        settings["cache_revalidate"] = DEFAULTS["cache_revalidate"]
+
+    # Validate bandwidth limits (KB/s; 0 = unlimited)
+    for key in ("max_download_kbs", "job_max_download_kbs"):
+        val = settings.get(key)
+        if not isinstance(val, int) or isinstance(val, bool) or val < 0:
+            settings[key] = DEFAULTS[key]
+
+    # Validate redundant sources
+    if not isinstance(settings.get("multi_source"), bool):
+        settings["multi_source"] = DEFAULTS["multi_source"]
+    mirrors = settings.get("mirrors")
+    if not isinstance(mirrors, list):
+        mirrors = []
+    settings["mirrors"] = [m.strip() for m in mirrors if isinstance(m, str) and m.strip()]
 
-    try:
-        with open(SETTINGS_FILE, "r") as f:
-            settings = json.load(f)
+    # Validate metrics export
+    if settings.get("metrics_sink") not in VALID_METRICS_SINKS:
+        settings["metrics_sink"] = DEFAULTS["metrics_sink"]
+    if not isinstance(settings.get("metrics_path"), str):
+        settings["metrics_path"] = DEFAULTS["metrics_path"]
+    return settings
 
-        # Fill missing keys with defaults
-        for key, val in DEFAULTS.items():
-            settings.setdefault(key, val)
 
-        # Validate num_connections
-        if settings.get("num_connections") not in VALID_THREADS:
-            settings["num_connections"] = DEFAULTS["num_connections"]
+class SettingsStore:
+    """
+    The settings file, loaded and validated once per process. get() serves
+    the cached copy and re-reads the file only when its mtime changes
+    (checked at most every CHECK_INTERVAL seconds); save() writes only when
+    something actually changed. Subscribers are called with the new settings
+    after every change, from whichever thread noticed it.
+    """
 
-        # Validate max_parallel
-        max_par = settings.get("max_parallel")
-        if not isinstance(max_par, int) or not (MIN_PARALLEL <= max_par <= MAX_PARALLEL):
-            settings["max_parallel"] = DEFAULTS["max_parallel"]
+    CHECK_INTERVAL = 1.0
 
-        # Optionally save corrected settings
-        save_settings(settings)
+    def __init__(self, path):
+        self.path = path
+        self._settings = None
+        self._mtime = None
+        self._checked = 0
+        self._subscribers = []
+        self._lock = threading.RLock()
 
-        return settings
-    except Exception:
-        return DEFAULTS.copy()
+    def _file_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read(self):
+        """ (settings, needs_write); settings is None if the file can't be parsed """
+        if not os.path.exists(self.path):
+            return copy.deepcopy(DEFAULTS), True
+        try:
+            with open(self.path, "r") as f:
+                raw = json.load(f)
+        except Exception:
+            return None, False
+        if not isinstance(raw, dict):
+            # Valid JSON but not a settings object; treated like a parse error
+            return None, False
+        settings = validate_settings(dict(raw))
+        # Write corrected settings back, as loading always has
+        return settings, settings != raw
+
+    def _write(self, settings):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(settings, f, indent=4)
+        os.replace(tmp, self.path)
+        self._mtime = self._file_mtime()
+
+    def poll(self):
+        """ Reload if the file changed on disk; cheap enough to call from a timer """
+        with self._lock:
+            now = time.monotonic()
+            if self._settings is not None and now - self._checked < self.CHECK_INTERVAL:
+                return
+            self._checked = now
+            mtime = self._file_mtime()
+            if self._settings is not None and mtime == self._mtime:
+                return
+            settings, needs_write = self._read()
+            if settings is None:
+                if self._settings is not None:
+                    # A typo or a half-written edit: keep the last good settings, and
+                    # leave the mtime so the next valid write is still picked up
+                    return
+                settings = copy.deepcopy(DEFAULTS)
+            self._mtime = mtime
+            if needs_write:
+                self._write(settings)
+            changed = settings != self._settings
+            first_load = self._settings is None
+            self._settings = settings
+        if changed and not first_load:
+            self._notify(settings)
+
+    def snapshot(self):
+        self.poll()
+        with self._lock:
+            return copy.deepcopy(self._settings)
+
+    def get(self, key, default=None):
+        self.poll()
+        return self._settings.get(key, default)
+
+    def __getitem__(self, key):
+        self.poll()
+        return self._settings[key]
+
+    def save(self, settings):
+        with self._lock:
+            settings = validate_settings(dict(settings))
+            if settings == self._settings and self._file_mtime() == self._mtime:
+                return
+            self._write(settings)
+            self._settings = settings
+        self._notify(dict(settings))
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _notify(self, settings):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(dict(settings))
+            except Exception as e:
+                print(f"[Settings] Subscriber failed: {e}", file=sys.stderr)
+
+
+store = SettingsStore(SETTINGS_FILE)
+
+
+def load_settings():
+    """ A copy of the current settings; safe to modify """
+    return store.snapshot()
 
 def save_settings(settings):
-    with open(SETTINGS_FILE, "w") as f:
-        json.dump(settings, f, indent=4)
+    store.save(settings)
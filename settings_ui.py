@@ -1,7 +1,8 @@
 import os
 import customtkinter as ctk
 from tkinter import filedialog, messagebox
-from settings import load_settings, save_settings
+from settings import load_settings, save_settings, VALID_ENGINES, VALID_OUTPUT_FORMATS
+from variants import VALID_VARIANT_POLICIES
 
 def build_settings_tab(notebook, on_settings_updated=None):
     config = load_settings()
@@ -60,10 +61,94 @@ def build_settings_tab(notebook, on_settings_updated=None):
     theme_menu = ctk.CTkOptionMenu(content, variable=theme_var, values=["light", "dark", "system"])
     theme_menu.grid(row=5, column=1, columnspan=2, padx=5, pady=10, sticky="w")
 
+    # Download Engine
+    ctk.CTkLabel(content, text="Download Engine:").grid(row=6, column=0, sticky="w", padx=5, pady=10)
+    engine_var = ctk.StringVar(value=config.get("engine", "threads"))
+    engine_menu = ctk.CTkOptionMenu(content, variable=engine_var, values=VALID_ENGINES)
+    engine_menu.grid(row=6, column=1, columnspan=2, padx=5, pady=10, sticky="w")
+
     # Notifications
     notify_var = ctk.BooleanVar(value=config.get("enable_notifications", True))
     notify_check = ctk.CTkCheckBox(content, text="Enable Download Notifications", variable=notify_var)
-    notify_check.grid(row=6, column=0, columnspan=3, sticky="w", padx=5, pady=10)
+    notify_check.grid(row=7, column=0, columnspan=3, sticky="w", padx=5, pady=10)
+
+    # Streamed muxing
+    stream_var = ctk.BooleanVar(value=config.get("stream_mux", False))
+    stream_check = ctk.CTkCheckBox(content, text="Mux While Downloading (stream segments into FFmpeg)", variable=stream_var)
+    stream_check.grid(row=8, column=0, columnspan=3, sticky="w", padx=5, pady=10)
+
+    # Adaptive connections
+    adaptive_var = ctk.BooleanVar(value=config.get("adaptive_connections", False))
+    adaptive_check = ctk.CTkCheckBox(content, text="Adapt Threads to Server (grow/shrink while downloading)", variable=adaptive_var)
+    adaptive_check.grid(row=9, column=0, columnspan=3, sticky="w", padx=5, pady=10)
+
+    # Connection budget shared by all downloads
+    ctk.CTkLabel(content, text="Max Connections per Host:").grid(row=10, column=0, sticky="w", padx=5, pady=10)
+    HOST_LIMITS = ["4", "8", "16", "32", "64", "128"]
+    host_value = str(config.get("per_host_connections", 32))
+    if host_value not in HOST_LIMITS:
+        host_value = "32"
+    host_var = ctk.StringVar(value=host_value)
+    host_menu = ctk.CTkOptionMenu(content, variable=host_var, values=HOST_LIMITS)
+    host_menu.grid(row=10, column=1, columnspan=2, padx=5, pady=10, sticky="w")
+
+    ctk.CTkLabel(content, text="Max Connections Total:").grid(row=11, column=0, sticky="w", padx=5, pady=10)
+    GLOBAL_LIMITS = ["16", "32", "64", "128", "256", "512"]
+    global_value = str(config.get("global_max_connections", 128))
+    if global_value not in GLOBAL_LIMITS:
+        global_value = "128"
+    global_var = ctk.StringVar(value=global_value)
+    global_menu = ctk.CTkOptionMenu(content, variable=global_var, values=GLOBAL_LIMITS)
+    global_menu.grid(row=11, column=1, columnspan=2, padx=5, pady=10, sticky="w")
+
+    # Variant (quality) selection
+    ctk.CTkLabel(content, text="Quality Selection:").grid(row=12, column=0, sticky="w", padx=5, pady=10)
+    variant_var = ctk.StringVar(value=config.get("variant_policy", "highest"))
+    variant_menu = ctk.CTkOptionMenu(content, variable=variant_var, values=VALID_VARIANT_POLICIES)
+    variant_menu.grid(row=12, column=1, columnspan=2, padx=5, pady=10, sticky="w")
+
+    ctk.CTkLabel(content, text="Max Resolution (height):").grid(row=13, column=0, sticky="w", padx=5, pady=10)
+    RESOLUTIONS = ["360", "480", "720", "1080", "1440", "2160"]
+    res_value = str(config.get("max_resolution", 1080))
+    if res_value not in RESOLUTIONS:
+        res_value = "1080"
+    res_var = ctk.StringVar(value=res_value)
+    res_menu = ctk.CTkOptionMenu(content, variable=res_var, values=RESOLUTIONS)
+    res_menu.grid(row=13, column=1, columnspan=2, padx=5, pady=10, sticky="w")
+
+    # Output container
+    ctk.CTkLabel(content, text="Output Format:").grid(row=14, column=0, sticky="w", padx=5, pady=10)
+    format_var = ctk.StringVar(value=config.get("output_format", "mp4"))
+    format_menu = ctk.CTkOptionMenu(content, variable=format_var, values=VALID_OUTPUT_FORMATS)
+    format_menu.grid(row=14, column=1, columnspan=2, padx=5, pady=10, sticky="w")
+
+    # Backup CDN hosts serving the same paths
+    ctk.CTkLabel(content, text="Mirror Hosts:").grid(row=15, column=0, sticky="w", padx=5, pady=10)
+    mirrors_var = ctk.StringVar(value=", ".join(config.get("mirrors", [])))
+    mirrors_entry = ctk.CTkEntry(content, textvariable=mirrors_var, width=300,
+                                 placeholder_text="https://cdn2.example.com, https://cdn3.example.com")
+    mirrors_entry.grid(row=15, column=1, columnspan=2, padx=5, pady=10, sticky="w")
+
+    # Local cache of downloaded segments, reused by later jobs
+    ctk.CTkLabel(content, text="Segment Cache (MB, 0 = off):").grid(row=16, column=0, sticky="w", padx=5, pady=10)
+    CACHE_SIZES = ["0", "1024", "4096", "16384", "65536"]
+    cache_value = str(config.get("segment_cache_mb", 0))
+    if cache_value not in CACHE_SIZES:
+        CACHE_SIZES.append(cache_value)
+    cache_var = ctk.StringVar(value=cache_value)
+    cache_menu = ctk.CTkOptionMenu(content, variable=cache_var, values=CACHE_SIZES)
+    cache_menu.grid(row=16, column=1, columnspan=2, padx=5, pady=10, sticky="w")
+
+    # Bandwidth caps, applied to running downloads as soon as they're saved
+    ctk.CTkLabel(content, text="Bandwidth Limit, All Downloads (KB/s, 0 = none):").grid(row=17, column=0, sticky="w", padx=5, pady=10)
+    limit_var = ctk.StringVar(value=str(config.get("max_download_kbs", 0)))
+    limit_entry = ctk.CTkEntry(content, textvariable=limit_var, width=120)
+    limit_entry.grid(row=17, column=1, columnspan=2, padx=5, pady=10, sticky="w")
+
+    ctk.CTkLabel(content, text="Bandwidth Limit per Download (KB/s, 0 = none):").grid(row=18, column=0, sticky="w", padx=5, pady=10)
+    job_limit_var = ctk.StringVar(value=str(config.get("job_max_download_kbs", 0)))
+    job_limit_entry = ctk.CTkEntry(content, textvariable=job_limit_var, width=120)
+    job_limit_entry.grid(row=18, column=1, columnspan=2, padx=5, pady=10, sticky="w")
 
     # Save Button
     def save():
@@ -95,14 +180,36 @@ def build_settings_tab(notebook, on_settings_updated=None):
                 messagebox.showerror("Invalid Value", "Max Parallel Downloads must be between 1 and 10.")
                 return
 
-            new_cfg = {
+            limits = []
+            for var in (limit_var, job_limit_var):
+                value = var.get().strip() or "0"
+                if not value.isdigit():
+                    messagebox.showerror("Invalid Value", "Bandwidth limits must be whole numbers of KB/s (0 = no limit).")
+                    return
+                limits.append(int(value))
+
+            # Start from the stored settings so keys without a widget (timeout, max_retries...) survive
+            new_cfg = load_settings()
+            new_cfg.update({
                 "output_dir": output_path,
                 "num_connections": threads,
                 "max_parallel": max_parallel,
                 "ffmpeg_path": ffmpeg_var.get().strip(),
                 "theme": theme_var.get(),
-                "enable_notifications": notify_var.get()
-            }
+                "engine": engine_var.get(),
+                "enable_notifications": notify_var.get(),
+                "stream_mux": stream_var.get(),
+                "adaptive_connections": adaptive_var.get(),
+                "per_host_connections": int(host_var.get()),
+                "global_max_connections": int(global_var.get()),
+                "variant_policy": variant_var.get(),
+                "max_resolution": int(res_var.get()),
+                "output_format": format_var.get(),
+                "mirrors": [m.strip() for m in mirrors_var.get().split(",") if m.strip()],
+                "segment_cache_mb": int(cache_var.get()),
+                "max_download_kbs": limits[0],
+                "job_max_download_kbs": limits[1]
+            })
 
             save_settings(new_cfg)
 
@@ -116,7 +223,7 @@ def build_settings_tab(notebook, on_settings_updated=None):
         except Exception as e:
             messagebox.showerror("Error", f"Failed to save settings:\n{e}")
 
-    ctk.CTkButton(content, text="💾 Save Settings", command=save).grid(row=7, column=0, columnspan=3, pady=(30, 10))
+    ctk.CTkButton(content, text="💾 Save Settings", command=save).grid(row=19, column=0, columnspan=3, pady=(30, 10))
 
     content.grid_columnconfigure(0, weight=1)
     content.grid_columnconfigure(1, weight=1)
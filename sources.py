@@ -0,0 +1,155 @@
+import random
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from byterange import segment_entries
+from http_pool import load_playlist
+from keys import segment_key
+from retry import get_breaker
+from variants import variant_url
+
+# Segment durations of equivalent playlists may be rounded differently
+DURATION_TOLERANCE = 0.05
+# Weight given to the newest throughput sample of a source
+SMOOTHING = 0.3
+
+
+def equivalent_variants(master, media_url, fallback_url):
+    """ URLs of the other variants carrying the same rendition (BANDWIDTH, RESOLUTION, CODECS) as media_url """
+    chosen = [v for v in master.playlists if variant_url(master, v, fallback_url) == media_url]
+    if not chosen:
+        return []
+    info = chosen[0].stream_info
+
+    def same(v):
+        other = v.stream_info
+        return (other.bandwidth, other.resolution, other.codecs) == (info.bandwidth, info.resolution, info.codecs)
+
+    return [variant_url(master, v, fallback_url) for v in master.playlists if same(v)]
+
+
+def mirror_url(url, base):
+    """ url served from a mirror: scheme and host of base, path and query of url """
+    mirror = urlparse(base if "//" in base else "//" + base)
+    return urlparse(url)._replace(scheme=mirror.scheme or urlparse(url).scheme, netloc=mirror.netloc).geturl()
+
+
+def _key_path(seg, sequence, url):
+    # Mirrors serve the key from their own host; what has to match is the key and IV themselves
+    key = segment_key(seg, sequence, url)
+    return (urlparse(key[0]).path, key[1]) if key else None
+
+
+def lines_up(playlist, other, other_url, media_url):
+    """ True if other lists the same segments as playlist: count, sequence, durations, byte ranges and keys """
+    if len(other.segments) != len(playlist.segments) or (other.media_sequence or 0) != (playlist.media_sequence or 0):
+        return False
+    first = playlist.media_sequence or 0
+    ours = segment_entries(playlist.segments, media_url)
+    theirs = segment_entries(other.segments, other_url)
+    for n, (a, b) in enumerate(zip(playlist.segments, other.segments)):
+        if abs((a.duration or 0) - (b.duration or 0)) > DURATION_TOLERANCE or ours[n][2] != theirs[n][2]:
+            return False
+        try:
+            if _key_path(a, first + n, media_url) != _key_path(b, first + n, other_url):
+                return False
+        except Exception:
+            return False
+    return True
+
+
+class Source:
+    """ One media playlist URL serving the job's segments, with its measured throughput """
+
+    def __init__(self, url, entries):
+        self.url = url
+        self.host = urlparse(url).netloc
+        self.urls = {i: segment_url for i, segment_url, _ in entries}
+        self.rate = None
+        self.inflight = 0
+
+
+class SourcePool:
+    """
+    Spreads a job's segment requests over equivalent sources. Each request
+    goes to a source picked at random, weighted by its smoothed bytes/s per
+    request over the requests it already has in flight. A failure halves a
+    source's estimate and an open circuit breaker takes its host out of
+    rotation, so work drains to the others while a host is degraded.
+    """
+
+    def __init__(self, sources):
+        self.sources = sources
+        self._lock = threading.Lock()
+
+    def healthy(self, source):
+        return not get_breaker(source.host).is_open()
+
+    def _best_rate(self):
+        known = [s.rate for s in self.sources if s.rate]
+        return max(known) if known else 1.0
+
+    def pick(self, avoid=None):
+        """ Source for the next request; avoid is a host to stay off if any other will do """
+        with self._lock:
+            healthy = [s for s in self.sources if self.healthy(s)] or self.sources
+            candidates = [s for s in healthy if s.host != avoid] or healthy
+            # Untried sources count as fast as the best one, so they get measured
+            default = self._best_rate()
+            weights = [(s.rate or default) / (s.inflight + 1) for s in candidates]
+            return random.choices(candidates, weights)[0]
+
+    def begin(self, source):
+        with self._lock:
+            source.inflight += 1
+
+    def end(self, source):
+        with self._lock:
+            source.inflight -= 1
+
+    def record(self, source, nbytes, seconds):
+        rate = nbytes / max(seconds, 1e-3)
+        with self._lock:
+            source.rate = rate if source.rate is None else source.rate + SMOOTHING * (rate - source.rate)
+
+    def record_failure(self, source):
+        with self._lock:
+            source.rate = (source.rate or self._best_rate()) / 2
+
+
+def resolve_sources(master, media_url, playlist, mirrors, fallback_url, timeout=10):
+    """
+    SourcePool over media_url plus every redundant variant of the same
+    rendition and every mirror host whose playlist lines up with it, or None
+    when there is nothing to spread over. Playlists that fail to load or
+    don't line up are skipped.
+    """
+    urls = equivalent_variants(master, media_url, fallback_url) if master else []
+    urls += [mirror_url(url, base) for url in [media_url, *urls] for base in mirrors]
+    candidates = []
+    for url in urls:
+        if url != media_url and url not in candidates:
+            candidates.append(url)
+    if not candidates:
+        return None
+
+    def load(url):
+        try:
+            return load_playlist(url, timeout=timeout)
+        except Exception as e:
+            print(f"[Sources] {url} unavailable: {e}", file=sys.stderr)
+            return None
+
+    with ThreadPoolExecutor(max_workers=len(candidates)) as pool:
+        loaded = list(pool.map(load, candidates))
+
+    sources = [Source(media_url, segment_entries(playlist.segments, media_url))]
+    for url, other in zip(candidates, loaded):
+        if other is None:
+            continue
+        if other.is_variant or not lines_up(playlist, other, url, media_url):
+            print(f"[Sources] {url} does not match {media_url}, not used", file=sys.stderr)
+            continue
+        sources.append(Source(url, segment_entries(other.segments, url)))
+    return SourcePool(sources) if len(sources) > 1 else None
@@ -0,0 +1,141 @@
+import time
+import zlib
+from keys import StreamDecryptor
+
+# Bytes read from the socket per chunk while streaming a segment to disk
+CHUNK_SIZE = 64 * 1024
+# Bytes decrypted per step when an encrypted segment is finished
+DECRYPT_CHUNK = 1024 * 1024
+
+
+class StreamingSegment:
+    """
+    One segment written into its region of the job's SegmentStore as it
+    downloads. The object outlives a failed attempt: the retry asks for
+    `Range: bytes=<received>-` and carries on in the same region instead of
+    starting the segment again. An encrypted segment is stored as it arrives
+    and decrypted in place by finish(), which runs on the CPU pool rather
+    than the network thread. A body sent without Content-Length is held in
+    memory instead and only given a region, of exactly its size, by finish().
+    """
+
+    def __init__(self, store, key=None, iv=None):
+        self.store = store
+        self.key = key
+        self.iv = iv
+        self.received = 0
+        self.written = 0
+        # Time spent decrypting and writing, kept apart from network time for the metrics
+        self.decrypt_seconds = 0.0
+        self.write_seconds = 0.0
+        self.offset = None
+        self.capacity = 0
+        # The body so far while its length is unknown, else None
+        self._buffer = None
+        # CRC32 of the stored (decrypted) bytes, for the journal
+        self.crc = 0
+        # Where the body came from and its ETag / Last-Modified, for the segment cache
+        self.validators = None
+
+    def resume_headers(self):
+        return {"Range": f"bytes={self.received}-"} if self.received else None
+
+    def begin(self, status, length=None):
+        """
+        Call with the response status and Content-Length before writing;
+        anything but 206 starts over. Reserves room for the rest of the body.
+        """
+        if not (status == 206 and self.received):
+            self.received = 0
+            self.written = 0
+            self.crc = 0
+            self._buffer = None
+        if self._buffer is not None:
+            return
+        if length:
+            self._ensure(self.received + length)
+        elif not self.received:
+            self._buffer = bytearray()
+
+    def _ensure(self, size):
+        if self.offset is not None and size <= self.capacity:
+            return
+        size = max(size, self.capacity * 2)
+        offset = self.store.reserve(size)
+        if self.received:
+            self.store.copy(self.offset, offset, self.received)
+        if self.offset is not None:
+            self.store.release(self.offset, self.capacity)
+        self.offset, self.capacity = offset, size
+
+    def write(self, chunk):
+        start = time.perf_counter()
+        if self._buffer is not None:
+            self._buffer += chunk
+        else:
+            self._ensure(self.received + len(chunk))
+            self.store.write(self.offset + self.received, chunk)
+        self.received += len(chunk)
+        self.written += len(chunk)
+        if not self.key:
+            self.crc = zlib.crc32(chunk, self.crc)
+        self.write_seconds += time.perf_counter() - start
+
+    def finish(self):
+        """ Decrypt if keyed; returns the segment's (offset, length) in the store, see crc """
+        if self._buffer is not None:
+            self._flush()
+        if self.key:
+            self._decrypt_in_place()
+        # Whatever was reserved past the body goes back to the store
+        self.store.release(self.offset + self.written, self.capacity - self.written)
+        self.capacity = self.written
+        return self.offset, self.written
+
+    def _flush(self):
+        start = time.perf_counter()
+        if self.offset is None or len(self._buffer) > self.capacity:
+            if self.offset is not None:
+                self.store.release(self.offset, self.capacity)
+            self.offset, self.capacity = self.store.reserve(len(self._buffer)), len(self._buffer)
+        self.store.write(self.offset, self._buffer)
+        self._buffer = None
+        self.write_seconds += time.perf_counter() - start
+
+    def served(self):
+        """ The body as received (still encrypted, if it is); call before finish() """
+        if self._buffer is not None:
+            return bytes(self._buffer)
+        return self.store.read(self.offset, self.received)
+
+    def _decrypt_in_place(self):
+        # Plaintext never runs ahead of the ciphertext read so far, so it can overwrite it in the same region
+        decryptor = StreamDecryptor(self.key, self.iv)
+        read_pos = write_pos = 0
+        self.crc = 0
+        while True:
+            start = time.perf_counter()
+            chunk = self.store.read(self.offset + read_pos, min(DECRYPT_CHUNK, self.received - read_pos))
+            read_pos += len(chunk)
+            decrypted = time.perf_counter()
+            data = decryptor.update(chunk) if chunk else decryptor.finalize()
+            written = time.perf_counter()
+            self.store.write(self.offset + write_pos, data)
+            self.crc = zlib.crc32(data, self.crc)
+            write_pos += len(data)
+            self.decrypt_seconds += written - decrypted
+            self.write_seconds += (decrypted - start) + (time.perf_counter() - written)
+            if not chunk:
+                break
+        self.written = write_pos
+
+    def discard(self):
+        # The region goes back to the store; a restart reserves afresh in begin()
+        if self.offset is not None:
+            self.store.release(self.offset, self.capacity)
+        self.offset = None
+        self.capacity = 0
+        self.received = 0
+        self.written = 0
+        self.crc = 0
+        self._buffer = None
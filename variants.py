@@ -0,0 +1,68 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+VALID_VARIANT_POLICIES = ["highest", "max_resolution", "fit_throughput", "first"]
+
+
+def bandwidth(variant):
+    info = variant.stream_info
+    return info.average_bandwidth or info.bandwidth or 0
+
+
+def height(variant):
+    resolution = variant.stream_info.resolution
+    return resolution[1] if resolution else None
+
+
+def variant_url(master, variant, fallback_url):
+    return urljoin(master.base_uri or fallback_url, variant.uri)
+
+
+def ranked(master):
+    """ Variants of a master playlist, highest bandwidth first """
+    return sorted(master.playlists, key=bandwidth, reverse=True)
+
+
+def select_variant(master, policy, max_height=None):
+    """ Pick a variant without touching the network (every policy except fit_throughput) """
+    variants = ranked(master)
+    if policy == "first":
+        return master.playlists[0]
+    if policy == "max_resolution" and max_height:
+        capped = [v for v in variants if height(v) is None or height(v) <= max_height]
+        # Nothing small enough: fall back to the lightest rendition
+        return capped[0] if capped else variants[-1]
+    return variants[0]
+
+
+def fit_variant(master, throughput, duration, target_seconds):
+    """
+    Highest-bandwidth variant expected to finish within target_seconds at the
+    measured throughput (bytes/s); the lightest one if none fits.
+    """
+    variants = ranked(master)
+    for v in variants:
+        expected_bytes = bandwidth(v) / 8 * duration
+        if throughput > 0 and expected_bytes / throughput <= target_seconds:
+            return v
+    return variants[-1]
+
+
+def probe_throughput(session, urls, timeout=10):
+    """ Fetch urls in parallel and return the aggregate throughput in bytes/s """
+    if not urls:
+        return 0.0
+
+    def fetch(url):
+        try:
+            r = session.get(url, timeout=timeout)
+            return len(r.content) if r.status_code == 200 else 0
+        except Exception:
+            return 0
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        total = sum(pool.map(fetch, urls))
+    elapsed = max(time.monotonic() - start, 1e-3)
+    return total / elapsed